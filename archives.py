@@ -0,0 +1,166 @@
+import os
+import stat
+import tarfile
+import zipfile
+
+# the most a single submission's archives can extract to, and the most files and directories they can have
+MAX_EXTRACTED_BYTES  = 256 * 1024 * 1024
+MAX_ARCHIVE_ENTRIES  = 1000
+# archives are read and written in chunks of this many bytes
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ZIP_EXTENSIONS = (".zip",)
+
+# junk some archivers add that is never part of a submission
+IGNORED_DIRS = ("__MACOSX",)
+
+# raised when an archive goes over a limit or can't be read, the submission it came from is skipped
+class Archive_Error(Exception):
+    pass
+
+def is_tar(filename):
+    return filename.lower().endswith(TAR_EXTENSIONS)
+
+def is_zip(filename):
+    return filename.lower().endswith(ZIP_EXTENSIONS)
+
+def is_archive(filename):
+    return is_tar(filename) or is_zip(filename)
+
+"""
+keeps count of what a submission's archives have extracted so far, every archive a submission has shares one
+so the limits are for the whole submission
+"""
+class Extract_Limits:
+    def __init__(self, max_bytes=MAX_EXTRACTED_BYTES, max_entries=MAX_ARCHIVE_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.bytes = 0
+        self.entries = 0
+
+    def add_entry(self, name):
+        self.entries += 1
+        if (self.entries > self.max_entries):
+            raise Archive_Error(f"an archive has more than {self.max_entries} files (at {name})")
+
+    def add_bytes(self, count, name):
+        self.bytes += count
+        if (self.bytes > self.max_bytes):
+            raise Archive_Error(f"an archive is more than {self.max_bytes // (1024 * 1024)}MB once extracted (at {name})")
+
+"""
+gets where an entry in an archive goes inside of dest, or None if it shouldn't be extracted. names that
+would end up outside of dest (absolute paths or ..) are an error, not just skipped
+"""
+def get_entry_path(dest, name):
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+
+    if (name.startswith("/") or ".." in parts):
+        raise Archive_Error(f"'{name}' in an archive would be extracted outside of the submission")
+    if (not parts or parts[0] in IGNORED_DIRS):
+        return None
+
+    return os.path.join(dest, *parts)
+
+# copies one entry out of an archive in chunks, counting the bytes as they are written instead of trusting the header
+def extract_entry(source, path, name, limits):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, "wb") as f:
+        for chunk in iter(lambda: source.read(ARCHIVE_CHUNK_SIZE), b""):
+            limits.add_bytes(len(chunk), name)
+            f.write(chunk)
+
+"""
+extracts a tar (compressed or not) from a stream as it is read, nothing is ever seeked so this works straight
+off of an http response. only regular files and directories are extracted, links and devices are skipped
+
+@params:
+    stream - a file like object the archive is read from
+    dest   - the directory to extract to
+    limits - the Extract_Limits for the submission
+"""
+def extract_tar_stream(stream, dest, limits):
+    try:
+        with tarfile.open(fileobj=stream, mode="r|*") as tar:
+            for member in tar:
+                path = get_entry_path(dest, member.name)
+                limits.add_entry(member.name)
+
+                if (path is None):
+                    continue
+
+                if (member.isdir()):
+                    os.makedirs(path, exist_ok=True)
+                elif (member.isreg()):
+                    extract_entry(tar.extractfile(member), path, member.name, limits)
+                    os.chmod(path, stat.S_IMODE(member.mode) | stat.S_IRUSR | stat.S_IWUSR)
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise Archive_Error(f"an archive could not be read as a tar: {e}")
+
+"""
+extracts a zip. a zip's table of contents is at the end of the file, so it has to be on disk before it can
+be read, the stream is copied to a temp file in dest's parent first (never into memory)
+
+@params:
+    stream - a file like object the archive is read from
+    dest   - the directory to extract to
+    limits - the Extract_Limits for the submission
+"""
+def extract_zip_stream(stream, dest, limits):
+    spool = f"{dest}.zip.part"
+
+    try:
+        with open(spool, "wb") as f:
+            for chunk in iter(lambda: stream.read(ARCHIVE_CHUNK_SIZE), b""):
+                # a zip can't extract to less than itself, so this stops huge downloads early
+                if (f.tell() + len(chunk) > limits.max_bytes):
+                    raise Archive_Error(f"an archive is more than {limits.max_bytes // (1024 * 1024)}MB")
+                f.write(chunk)
+
+        with zipfile.ZipFile(spool) as archive:
+            for info in archive.infolist():
+                path = get_entry_path(dest, info.filename)
+                limits.add_entry(info.filename)
+
+                if (path is None):
+                    continue
+
+                # zips made on unix keep the file type and permissions in the top of external_attr, some only
+                # keep the permissions, and zips made anywhere else have neither
+                mode = info.external_attr >> 16
+                if (info.is_dir()):
+                    os.makedirs(path, exist_ok=True)
+                elif (stat.S_IFMT(mode) in (0, stat.S_IFREG)):
+                    with archive.open(info) as source:
+                        extract_entry(source, path, info.filename, limits)
+                    if (mode):
+                        os.chmod(path, stat.S_IMODE(mode) | stat.S_IRUSR | stat.S_IWUSR)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError, OSError) as e:
+        raise Archive_Error(f"an archive could not be read as a zip: {e}")
+    finally:
+        if (os.path.exists(spool)):
+            os.remove(spool)
+
+# extracts a tar or a zip from a stream
+def extract_archive_stream(filename, stream, dest, limits):
+    os.makedirs(dest, exist_ok=True)
+
+    if (is_zip(filename)):
+        extract_zip_stream(stream, dest, limits)
+    else:
+        extract_tar_stream(stream, dest, limits)
+
+"""
+gets every file under a directory, relative to it, with the files closest to the top first and then in
+alphabetical order
+"""
+def list_files(directory):
+    files = []
+
+    for root, _, names in os.walk(directory):
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root, name), directory))
+
+    return sorted(files, key=lambda f: (f.count(os.sep), f))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from shutil import rmtree
+
+BENCH_DIR    = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR     = os.path.dirname(BENCH_DIR)
+RESULTS_FILE = os.path.join(BENCH_DIR, "canvas_results.jsonl")
+
+sys.path.insert(0, REPO_DIR)
+from fake_canvas import start_fake_canvas
+from submission_index import parse_student_id
+from results_store import Results_Store
+from gradingtools import Grade_Result, record_result
+
+ASSIGNMENT_ID = 4242
+
+"""
+records a result (and writes a feedback file) for every submission that was downloaded, the same as a
+grading run would, so there is something to upload
+"""
+def write_results(dir_to_grade):
+    submissions = [s for s in sorted(os.listdir(dir_to_grade)) if parse_student_id(s) is not None]
+
+    store = Results_Store(dir_to_grade)
+    store.start_run("bench_canvas", upload=True)
+
+    for submission in submissions:
+        student_name, student_id = submission.split("_")[:2]
+        result = Grade_Result(student_name, student_id, submission.split(".")[0], 20)
+        os.makedirs(os.path.join(dir_to_grade, result.sub_file))
+
+        with open(result.feedback_path(dir_to_grade), "w") as f:
+            f.write("Your score: 20/20\n")
+        record_result(store, dir_to_grade, result)
+
+    return store
+
+# times a function, returns how long it took
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+# gets the arguments for the program
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmarks downloading and uploading against fake_canvas.py")
+    parser.add_argument("-n", "--submissions", type=int, default=200, help="The number of submissions in the fake course")
+    parser.add_argument("--size", type=int, default=4096, help="The size of every attachment, in bytes")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Up to this many more seconds are added at random")
+    parser.add_argument("--throttle", type=float, default=0.0, help="The chance (0-1) a request gets a 429")
+    parser.add_argument("--failures", type=float, default=0.0, help="The chance (0-1) a request gets a 500 or 503")
+    parser.add_argument("--no-save", action="store_true", help="Don't store the results in benchmarks/canvas_results.jsonl")
+    return parser.parse_args()
+
+# main
+if (__name__ == "__main__"):
+    args = get_args()
+
+    server = start_fake_canvas(submissions=args.submissions, attachment=b"/* padding */\n" * (args.size // 14 + 1),
+                               latency=args.latency, jitter=args.jitter, throttle=args.throttle, failures=args.failures)
+
+    # canvas_utils reads where Canvas is the first time it needs it
+    os.environ.update(CANVAS_BASE_URL=server.url, COURSE_ID="1", CANVAS_API_KEY="fake")
+    import canvas_utils
+
+    dir_to_grade = tempfile.mkdtemp(prefix="canvas_bench_") + "/"
+
+    try:
+        download_seconds = timed(canvas_utils.download_submissions, ASSIGNMENT_ID, dir_to_grade, False)
+        store = write_results(dir_to_grade)
+        upload_seconds = timed(canvas_utils.attach_files_and_grade, ASSIGNMENT_ID, dir_to_grade, store)
+    finally:
+        rmtree(dir_to_grade)
+        server.shutdown()
+
+    stats = server.state.stats()
+    result = {
+        "mode":                "canvas",
+        "submissions":         args.submissions,
+        "download_per_second": round(args.submissions / download_seconds, 2),
+        "upload_per_second":   round(args.submissions / upload_seconds, 2),
+        "requests":            sum(stats["requests"].values()),
+        "errors":              stats["errors"],
+        "latency":             args.latency,
+        "throttle":            args.throttle,
+        "failures":            args.failures,
+        "time":                time.time(),
+    }
+
+    print(f"\nDownloaded {args.submissions} submissions in {download_seconds:.2f}s ({result['download_per_second']}/s)")
+    print(f"Uploaded {stats['comments']} comments and {stats['grades']} grades in {upload_seconds:.2f}s ({result['upload_per_second']}/s)")
+    print(f"{result['requests']} requests, errors injected: {json.dumps(stats['errors'])}")
+
+    if (not args.no_save):
+        with open(RESULTS_FILE, "a") as f:
+            f.write(json.dumps(result) + "\n")
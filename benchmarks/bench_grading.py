@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess as sp
+from shutil import copy, copytree, rmtree
+
+BENCH_DIR     = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR      = os.path.dirname(BENCH_DIR)
+EXAMPLE_DIR   = os.path.join(REPO_DIR, "local_example")
+RESULTS_FILE  = os.path.join(BENCH_DIR, "results.jsonl")
+
+# the example submissions each kind of synthesized submission is copied from, None is made up below
+SUBMISSION_KINDS = {
+    "correct":      "johnsmith_1234.c",
+    "wrong":        "joedavidson_2222.c",
+    "crash":        "wendywilson_6784.c",
+    "infiniteloop": "davidjackson_1111.c",
+    "nocompile":    None,
+}
+
+"""
+the ways gradingtools.py is run, each mode is benchmarked on its own copy of the submissions
+    flags  - the extra flags for gradingtools.py
+    warmup - whether to grade everything once before the timed run, so the caches are full
+"""
+MODES = {
+    "sequential": {"flags": ["--no-cache"], "warmup": False},
+    "parallel":   {"flags": ["--no-cache", "--jobs", str(os.cpu_count())], "warmup": False},
+    "cached":     {"flags": [], "warmup": True},
+}
+
+"""
+writes n submissions to dir, split as evenly as possible between the kinds of submissions. every submission
+gets its own comment so none of them are byte for byte the same, the same as a real class
+"""
+def synthesize_submissions(dir_, n, kinds):
+    for i in range(n):
+        kind = kinds[i % len(kinds)]
+
+        if (SUBMISSION_KINDS[kind] is None):
+            source = "int main(int argc, char** argv) {\n    return 0\n}\n"
+        else:
+            with open(os.path.join(EXAMPLE_DIR, SUBMISSION_KINDS[kind])) as f:
+                source = f.read()
+
+        # submissions are named like <name>_<canvas id>.c, just like the local example
+        with open(os.path.join(dir_, f"{kind}{i}_{100000 + i}.c"), "w") as f:
+            f.write(f"// synthesized submission {i} ({kind})\n{source}")
+
+"""
+sets up a directory to grade in, with the example's reference, generator and json file (with the
+benchmark's timeout, and a fixed seed so every run grades against the same input) next to a directory
+of synthesized submissions
+"""
+def make_bench_dir(n, kinds, timeout):
+    bench_dir = tempfile.mkdtemp(prefix="grading_bench_")
+
+    for f in ["reference", "quote_picker.py"]:
+        copy(os.path.join(EXAMPLE_DIR, f), bench_dir)
+
+    with open(os.path.join(EXAMPLE_DIR, "local_grading.json")) as f:
+        grading_json = json.load(f)
+    grading_json["timeout"] = timeout
+    grading_json["generator_seeds"] = [0]
+
+    with open(os.path.join(bench_dir, "bench_grading.json"), "w") as f:
+        json.dump(grading_json, f, indent=4)
+
+    os.mkdir(os.path.join(bench_dir, "submissions"))
+    synthesize_submissions(os.path.join(bench_dir, "submissions"), n, kinds)
+
+    return bench_dir
+
+"""
+runs gradingtools.py once, returns the wall time and the peak rss (in kb) of it and everything it started
+"""
+def run_grader(grader, bench_dir, subs_dir, flags, trace_file):
+    cmd = [sys.executable, grader, "-d", subs_dir, "-j", "bench_grading.json", "--local", "--debug", "--trace", trace_file] + flags
+
+    with open(os.path.join(bench_dir, "grader.log"), "a") as log:
+        start = time.perf_counter()
+        process = sp.Popen(cmd, cwd=bench_dir, stdout=log, stderr=sp.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if (process.returncode != 0):
+        print(f"Error: '{' '.join(cmd)}' exited with {process.returncode}, see {bench_dir}/grader.log")
+        exit(1)
+
+    return wall, rusage.ru_maxrss
+
+# gets a percentile from a sorted list with the nearest rank method
+def percentile(sorted_values, p):
+    if (not sorted_values):
+        return 0.0
+    rank = max(1, round(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+"""
+benchmarks one mode, the submissions are copied fresh for each mode so no mode gets another's caches
+
+@params:
+    grader    - the gradingtools.py to benchmark
+    bench_dir - the directory made by make_bench_dir
+    mode      - the name of the mode in MODES
+    n         - the number of submissions
+"""
+def bench_mode(grader, bench_dir, mode, n):
+    subs_dir   = f"{mode}_submissions"
+    trace_file = os.path.join(bench_dir, f"{mode}.trace.jsonl")
+    copytree(os.path.join(bench_dir, "submissions"), os.path.join(bench_dir, subs_dir))
+
+    if (MODES[mode]["warmup"]):
+        run_grader(grader, bench_dir, subs_dir, MODES[mode]["flags"], trace_file)
+
+    wall, peak_rss_kb = run_grader(grader, bench_dir, subs_dir, MODES[mode]["flags"], trace_file)
+
+    with open(trace_file) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    latencies = sorted(e["duration"] for e in events if e["name"] == "grade")
+
+    return {
+        "mode":            mode,
+        "submissions":     n,
+        "wall_seconds":    round(wall, 3),
+        "subs_per_second": round(n / wall, 2),
+        "p50_ms":          round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms":          round(percentile(latencies, 95) * 1000, 1),
+        "peak_rss_mb":     round(peak_rss_kb / 1024, 1),
+    }
+
+# gets the commit being benchmarked, so results from different versions can be told apart
+def get_commit(grader):
+    process = sp.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(grader)),
+                     universal_newlines=True, stdout=sp.PIPE, stderr=sp.DEVNULL)
+    return process.stdout.strip() if process.returncode == 0 else "unknown"
+
+# gets the last stored result for the same mode and number of submissions, to compare against
+def get_previous_result(result):
+    if (not os.path.isfile(RESULTS_FILE)):
+        return None
+
+    previous = None
+    with open(RESULTS_FILE) as f:
+        for line in f:
+            stored = json.loads(line)
+            if (stored["mode"] == result["mode"] and stored["submissions"] == result["submissions"] and stored["kinds"] == result["kinds"]):
+                previous = stored
+
+    return previous
+
+def print_result(result, previous):
+    print(f"{result['mode']:<12} {result['subs_per_second']:>10} {result['p50_ms']:>10} {result['p95_ms']:>10} {result['peak_rss_mb']:>10}", end="")
+
+    if (previous):
+        change = (result["subs_per_second"] - previous["subs_per_second"]) / previous["subs_per_second"] * 100
+        print(f"   {change:+.1f}% subs/s vs {previous['commit']}", end="")
+    print()
+
+# gets the arguments for the program
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmarks grading throughput on classes of submissions made from local_example")
+    parser.add_argument("-n", "--submissions", type=int, default=50, help="The number of submissions to grade in each mode")
+    parser.add_argument("--kinds", type=str, nargs="+", default=list(SUBMISSION_KINDS), choices=list(SUBMISSION_KINDS), help="The kinds of submissions to make, split evenly")
+    parser.add_argument("--modes", type=str, nargs="+", default=list(MODES), choices=list(MODES), help="The modes to benchmark")
+    parser.add_argument("--timeout", type=int, default=1, help="The timeout for each run, this is how long every infinite loop takes")
+    parser.add_argument("--grader", type=str, default=os.path.join(REPO_DIR, "gradingtools.py"), help="The gradingtools.py to benchmark")
+    parser.add_argument("--no-save", action="store_true", help="Don't store the results in benchmarks/results.jsonl")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark directory (submissions, feedback, traces) instead of deleting it")
+    return parser.parse_args()
+
+# main
+if (__name__ == "__main__"):
+    args = get_args()
+    grader = os.path.abspath(args.grader)
+    commit = get_commit(grader)
+
+    bench_dir = make_bench_dir(args.submissions, args.kinds, args.timeout)
+    print(f"Benchmarking {grader} ({commit}) on {args.submissions} submissions ({', '.join(args.kinds)})\n")
+    print(f"{'Mode':<12} {'Subs/s':>10} {'p50 (ms)':>10} {'p95 (ms)':>10} {'RSS (MB)':>10}")
+
+    try:
+        for mode in args.modes:
+            result = bench_mode(grader, bench_dir, mode, args.submissions)
+            result.update(commit=commit, kinds=args.kinds, timeout=args.timeout, time=time.time())
+
+            print_result(result, get_previous_result(result))
+
+            if (not args.no_save):
+                with open(RESULTS_FILE, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+    finally:
+        if (args.keep):
+            print(f"\nBenchmark files kept in {bench_dir}")
+        else:
+            rmtree(bench_dir)
@@ -1,103 +1,474 @@
-import canvasapi as capi
-import csv
 import json
-import requests
-import dotenv
 import os
+import random
 import re
+import time
 
-from os import getenv, mkdir, listdir, remove
-from os.path import isdir, isfile
+from os import getenv, mkdir, listdir
+from os.path import isdir, isfile, join
+from shutil import rmtree
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# load environment variales from .env file
-dotenv.load_dotenv()
+from submission_index import Submission_Index, get_attachments_dir
+from archives import Extract_Limits, is_archive, extract_archive_stream, list_files
+from results_store import UNCHANGED
+from run_trace import phase
 
 class Student_Info:
-    def __init__(self, student_name, student_id, grade, feedback_file):
+    def __init__(self, student_name, student_id, grade, feedback_file, attempt_id=None):
         self.student_name = student_name
         self.id = student_id
         self.grade = grade
         self.feedback_file = feedback_file
+        self.attempt_id = attempt_id
 
     def __str__(self):
         return f"id: {self.id}, grade: {self.grade}, feedback: {self.feedback_file}"
 
-if (not getenv("COURSE_ID")):
-    print("Error: COURDE_ID not found in .env")
-    exit(1)
+# the Canvas to talk to unless CANVAS_BASE_URL says otherwise (it can be pointed at fake_canvas.py for testing)
+DEFAULT_BASE_URL = "https://canvas.vt.edu/"
 
-if (not getenv("CANVAS_API_KEY")):
-    print("Error: CANVAS_API_KEY not found in .env")
-    exit(1)
+# the course being graded, it isn't connected to until something actually needs Canvas
+_course = None
 
-BASE_URL  = "https://canvas.vt.edu/"
-COURSE_ID = getenv("COURSE_ID")
+"""
+gets the course being graded. the first call loads the .env file, checks it and connects to Canvas, nothing
+Canvas related (not even canvasapi or requests) is loaded before then, so local grading never needs any of it
+"""
+def get_course():
+    global _course
+
+    if (_course is None):
+        import dotenv
+        import canvasapi as capi
+
+        # load environment variales from .env file
+        dotenv.load_dotenv()
+
+        if (not getenv("COURSE_ID")):
+            print("Error: COURSE_ID not found in .env")
+            exit(1)
 
-canvas = capi.Canvas(BASE_URL, getenv("CANVAS_API_KEY"))
-course = canvas.get_course(COURSE_ID)
+        if (not getenv("CANVAS_API_KEY")):
+            print("Error: CANVAS_API_KEY not found in .env")
+            exit(1)
 
-def get_current_submissions(dir_to_grade):
-    curr_subs = []
+        canvas  = capi.Canvas(getenv("CANVAS_BASE_URL", DEFAULT_BASE_URL), getenv("CANVAS_API_KEY"))
+        _course = canvas.get_course(getenv("COURSE_ID"))
 
-    for i in os.listdir(dir_to_grade):
-        if (isdir(dir_to_grade + i)):
-            curr_subs.append(dir_to_grade + i)
+    return _course
+
+# how many submissions are downloaded at the same time
+DOWNLOAD_WORKERS = 8
+# how many times a request is retried, and the base wait (in seconds) between tries, it doubles every try
+MAX_RETRIES     = 5
+BACKOFF_SECONDS = 1
+# submissions are streamed to disk in chunks of this many bytes
+CHUNK_SIZE = 64 * 1024
+# downloads are written here first and only moved in with the rest of the submissions once they are complete
+DOWNLOAD_DIR = ".downloads"
 
-    return curr_subs
-    
-def remove_old_submission(dir_to_grade, id):
-    for f in listdir(dir_to_grade):
-        if ("." in f and str(id) in f):
-            os.remove(f"{dir_to_grade}/{f}")
-        elif (str(id) in f):
-            for i in listdir(f"{dir_to_grade}{f}"):
-                os.remove(f"{dir_to_grade}{f}/{i}")
-            os.removedirs(f"{dir_to_grade}{f}")
 """
-downloads submissions from Canvas, currently just regrades all submissions, not just
-new ones 
+makes a session for downloading, its connection pool is big enough that every download worker can keep
+its connection alive between downloads
 """
-def download_submissions(assignment_id, dir_to_grade, regrade):
-    current_submissions = get_current_submissions(dir_to_grade)
-    dont_grade = []    
+def make_session(pool_size=DOWNLOAD_WORKERS):
+    import requests
 
-    if (not isdir(dir_to_grade)):
-        mkdir(dir_to_grade)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# how long to wait before trying a request again, exponential with some jitter so workers don't retry in lockstep
+def backoff(attempt):
+    return BACKOFF_SECONDS * (2 ** attempt) + random.uniform(0, BACKOFF_SECONDS)
+
+"""
+sends a GET, retrying with backoff on connection errors, 429s and 5xx responses. for a 429 the wait 
+comes from the Retry-After header when Canvas sends one
+"""
+def get_with_retries(session, url, **kwargs):
+    import requests
+
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = session.get(url, allow_redirects=True, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if (attempt == MAX_RETRIES):
+                raise
+            time.sleep(backoff(attempt))
+            continue
+
+        if (response.status_code == 429 or response.status_code >= 500) and attempt < MAX_RETRIES:
+            wait = backoff(attempt)
+            if (response.status_code == 429 and response.headers.get("Retry-After", "").isdigit()):
+                wait = int(response.headers["Retry-After"])
+
+            response.close()
+            time.sleep(wait)
+            continue
+
+        response.raise_for_status()
+        return response
+
+"""
+streams a file to disk in binary chunks, so the body is never held in memory
+"""
+def download_file(session, url, filename):
+    with phase("download", file=os.path.basename(filename)):
+        with get_with_retries(session, url, stream=True) as response:
+            with open(filename, "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+
+# the submissions for an assignment are cached here, so downloading and uploading share one fetch
+METADATA_CACHE_FILENAME = ".canvas_cache.json"
+# how long (in seconds) the cached submissions can be used for by later runs that only upload, downloading
+# always gets a fresh list so new and late submissions aren't missed
+METADATA_CACHE_TTL = 30 * 60
+# the biggest page size Canvas allows
+PAGE_SIZE = 100
+
+# submissions already fetched by this run, and when Canvas sent them, keyed on assignment id
+_submissions_this_run = {}
+_fetched_at = {}
+
+# gets the attributes Canvas sent for an object, without the extra *_date attributes canvasapi adds
+def get_raw_attributes(canvas_object):
+    attributes = {k: v for k, v in vars(canvas_object).items() if not k.startswith("_")}
+    attributes = {k: v for k, v in attributes.items() if not (k.endswith("_date") and k[:-5] in attributes)}
 
-    student_id_to_name = {}
+    if ("attachments" in attributes):
+        attributes["attachments"] = get_attachments(canvas_object)
 
-    assignment = course.get_assignment(assignment_id)
-    students = assignment.get_gradeable_students()
+    return attributes
 
-    for s in students:
-        student_id_to_name[s.id] = s.display_name
+# gets a submission's attachments as dicts, newer versions of canvasapi wrap them in File objects
+def get_attachments(sub):
+    return [a if isinstance(a, dict) else get_raw_attributes(a) for a in sub.attachments]
+
+"""
+gets all the submissions for an assignment, with each student's user info embedded so the students
+don't need to be looked up separately. the submissions are only fetched once per run, and are cached in 
+the dir to grade so that runs within max_age of each other don't fetch them again either (plan_downloads
+passes 0, so only uploads ever use the cache from an earlier run)
+
+@params:
+    assignment_id - the assignment to get the submissions for
+    dir_to_grade  - the directory to grade and download submissions to
+    max_age       - how old (in seconds) the cache can be to still be used
+"""
+def get_submissions(assignment_id, dir_to_grade, max_age=METADATA_CACHE_TTL):
+    from canvasapi.assignment import Assignment
+    from canvasapi.submission import Submission
 
-    submissions = assignment.get_submissions()
+    cache_file = join(dir_to_grade, METADATA_CACHE_FILENAME)
 
-    for sub in submissions:
-        if (sub.attempt is not None):
-            # gets the submission download url
-            url = sub.attachments[0]["url"]
-            # gets the submission display name
-            sub_name = sub.attachments[0]["display_name"]
+    if (assignment_id not in _submissions_this_run and isfile(cache_file)):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if (cached["assignment_id"] == assignment_id and time.time() - cached["fetched_at"] <= max_age):
+            _submissions_this_run[assignment_id] = cached["submissions"]
+            _fetched_at[assignment_id] = cached["fetched_at"]
 
+    if (assignment_id not in _submissions_this_run):
+        # the assignment doesn't need to be fetched just to list its submissions
+        with phase("canvas fetch", assignment_id=assignment_id):
+            assignment = Assignment(get_course()._requester, {"id": assignment_id, "course_id": get_course().id})
+            submissions = [get_raw_attributes(sub) for sub in assignment.get_submissions(include=["user"], per_page=PAGE_SIZE)]
+        fetched_at = time.time()
+
+        with open(f"{cache_file}.tmp", "w") as f:
+            json.dump({"assignment_id": assignment_id, "fetched_at": fetched_at, "submissions": submissions}, f, default=str)
+        os.replace(f"{cache_file}.tmp", cache_file)
+
+        _submissions_this_run[assignment_id] = submissions
+        _fetched_at[assignment_id] = fetched_at
+
+    return [Submission(get_course()._requester, attributes) for attributes in _submissions_this_run[assignment_id]]
+
+# gets a student's display name from the user info embedded in their submission
+def get_student_name(sub):
+    user = getattr(sub, "user", None) or {}
+    return user.get("short_name") or user.get("name") or str(sub.user_id)
+
+# keeps track of what was last downloaded for each student, lives in the dir to grade
+MANIFEST_FILENAME = ".sync_manifest.json"
+
+"""
+loads the sync manifest for a dir to grade, it maps each student's Canvas id to the metadata of the 
+submission that was last downloaded for them
+"""
+def load_manifest(dir_to_grade):
+    if (not isfile(f"{dir_to_grade}{MANIFEST_FILENAME}")):
+        return {}
+
+    with open(f"{dir_to_grade}{MANIFEST_FILENAME}") as f:
+        return json.load(f)
+
+# saves the sync manifest, it is written to a temp file first so a crash never leaves half of a manifest
+def save_manifest(dir_to_grade, manifest):
+    with open(f"{dir_to_grade}{MANIFEST_FILENAME}.tmp", "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(f"{dir_to_grade}{MANIFEST_FILENAME}.tmp", f"{dir_to_grade}{MANIFEST_FILENAME}")
+
+# the metadata that tells us if a submission has changed since it was last downloaded
+def get_submission_metadata(sub):
+    return {
+        "attempt":      sub.attempt,
+        "submitted_at": getattr(sub, "submitted_at", None),
+        "attachments":  [{"id": a["id"], "size": a.get("size")} for a in get_attachments(sub)],
+    }
+
+"""
+checks if a student's submission is the same as the last time it was downloaded. the manifest entry is the
+submission's metadata, plus the name of the file that was graded
+"""
+def is_unchanged(dir_to_grade, entry, metadata):
+    if (entry is None or "filename" not in entry):
+        return False
+    return all(entry.get(k) == v for k, v in metadata.items()) and isfile(f"{dir_to_grade}{entry['filename']}")
+
+# removes a student's old submission and grading directory, index lookups are by exact Canvas id
+def remove_old_submission(dir_to_grade, id, index=None):
+    if (index is None):
+        index = Submission_Index(dir_to_grade)
+    index.remove_student(id)
+"""
+a submission that needs to be downloaded. all of its attachments are downloaded to temp_dir first (archives
+are extracted as they download), and only moved in with the rest of the submissions once everything is there
+"""
+class Download:
+    def __init__(self, sub, student_name, prefix, temp_dir, metadata):
+        self.sub = sub
+        self.student_name = student_name
+        self.prefix = prefix
+        self.temp_dir = temp_dir
+        self.metadata = metadata
+        self.attachments = get_attachments(sub)
+
+    # where the attachments (and whatever the archives extract to) go while downloading
+    def files_dir(self):
+        return join(self.temp_dir, "files")
+
+"""
+works out which submissions need to be downloaded, submissions that are the same as the last time they were 
+downloaded (according to the sync manifest) are skipped. returns the downloads and the submissions that 
+shouldn't be graded
+
+@params:
+    assignment_id - the Canvas id of the assignment
+    dir_to_grade  - the directory to grade and download submissions to
+    regrade       - whether submissions that haven't changed still get graded
+    manifest      - the sync manifest for the dir to grade
+"""
+def plan_downloads(assignment_id, dir_to_grade, regrade, manifest):
+    downloads  = []
+    dont_grade = []
+
+    if (not isdir(f"{dir_to_grade}{DOWNLOAD_DIR}")):
+        mkdir(f"{dir_to_grade}{DOWNLOAD_DIR}")
+
+    # an older list could be missing new or late submissions, so it is always fetched again here
+    for sub in get_submissions(assignment_id, dir_to_grade, max_age=0):
+        if (sub.attempt is not None and get_attachments(sub)):
             # gets the student's id number
             sub_stud_id = sub.user_id
             # gets the students name with any illegal characers removed
-            stud_name = remove_illegal_chars(student_id_to_name[sub_stud_id])
+            stud_name = remove_illegal_chars(get_student_name(sub))
 
-            # downloads the submission
-            print(f"Downloading submission for {stud_name}...")
-            sub_content = requests.get(url, allow_redirects=True).text 
+            metadata = get_submission_metadata(sub)
+            entry = manifest.get(str(sub_stud_id))
 
-            generated_file = f"{dir_to_grade}{stud_name}_{sub_stud_id}_{assignment_id}_{sub_name}"
+            # submissions that haven't changed since they were last downloaded are never fetched again, 
+            # and only get regraded when forced to
+            if (is_unchanged(dir_to_grade, entry, metadata)):
+                if (not regrade):
+                    dont_grade.append(f"{dir_to_grade}{entry['filename']}")
+                continue
 
-            # ensures only new submissions are graded
-            if (generated_file.split(".")[0] not in current_submissions or regrade):
-                remove_old_submission(dir_to_grade, sub_stud_id)
-                open(f"{dir_to_grade}{stud_name}_{sub_stud_id}_{assignment_id}_{sub_name}", "w").write(sub_content)
+            downloads.append(Download(sub, stud_name, f"{stud_name}_{sub_stud_id}_{assignment_id}", 
+                                      f"{dir_to_grade}{DOWNLOAD_DIR}/{sub_stud_id}", metadata))
+
+    return (downloads, dont_grade)
+
+"""
+downloads all of a submission's attachments into its temp directory. archives are extracted straight from 
+the response as it comes in, with limits on how much they can extract to (see archives.py). raises an 
+Archive_Error if an archive can't be extracted
+"""
+def fetch_submission(session, download):
+    if (isdir(download.temp_dir)):
+        rmtree(download.temp_dir)
+    os.makedirs(download.files_dir())
+
+    limits = Extract_Limits()
+
+    try:
+        for attachment in download.attachments:
+            name = os.path.basename(attachment["display_name"])
+
+            if (is_archive(name)):
+                with phase("download", file=name), get_with_retries(session, attachment["url"], stream=True) as response:
+                    # anything the server compressed on the way is decompressed before it gets to the archive reader
+                    response.raw.decode_content = True
+                    extract_archive_stream(name, response.raw, download.files_dir(), limits)
             else:
-                dont_grade.append(generated_file)
+                download_file(session, attachment["url"], join(download.files_dir(), name))
+    except Exception:
+        rmtree(download.temp_dir, ignore_errors=True)
+        raise
+
+"""
+picks the file that gets graded out of a submission's files. the attachments that aren't archives are looked
+at first (in the order they were attached), then the files that were extracted (closest to the top, then
+alphabetical): the first one is_preferred says looks like the student's source wins, otherwise the first one
+is_primary says could be graded
+"""
+def pick_primary(download, files_dir, is_primary=None, is_preferred=None):
+    attached = [os.path.basename(a["display_name"]) for a in download.attachments]
+    attached = [name for name in attached if not is_archive(name) and isfile(join(files_dir, name))]
+    files = attached + [f for f in list_files(files_dir) if f not in attached]
+
+    # a zip with a Makefile and a README in it (or a notes.txt next to the code) should still have its source graded
+    if (is_preferred is not None):
+        for f in files:
+            if (is_preferred(os.path.basename(f))):
+                return f
+
+    for f in files:
+        if (is_primary is None or is_primary(os.path.basename(f))):
+            return f
+
+    return None
+
+"""
+moves a finished download into the dir to grade, replacing the student's old submission. the file that
+gets graded is put in the dir to grade like always, the rest of the student's files go in its attachments
+directory next to it. files in the dir to grade are only ever touched from one thread, so this must never 
+be called from a download thread. returns the name of the submission, or None if there was nothing to grade
+
+@params:
+    dir_to_grade - the directory to grade and download submissions to
+    download     - the Download, after fetch_submission
+    index        - the submission index for the dir to grade
+    manifest     - the sync manifest for the dir to grade
+    is_primary   - checks if an extracted file could be the one that gets graded
+    is_preferred - checks if an extracted file looks like the one that should be graded, see pick_primary
+"""
+def finish_download(dir_to_grade, download, index, manifest, is_primary=None, is_preferred=None):
+    files_dir = download.files_dir()
+
+    # an archive of one folder (the usual way a project is zipped up) is graded from inside of that folder
+    entries = listdir(files_dir)
+    if (len(entries) == 1 and isdir(join(files_dir, entries[0])) and len(download.attachments) == 1):
+        files_dir = join(files_dir, entries[0])
+
+    primary = pick_primary(download, files_dir, is_primary, is_preferred)
+    if (primary is None):
+        print(f"Error: {download.student_name}'s submission has no file that can be graded, skipping it")
+        rmtree(download.temp_dir)
+        return None
+
+    remove_old_submission(dir_to_grade, download.sub.user_id, index)
+
+    submission = f"{download.prefix}_{os.path.basename(primary)}"
+    os.replace(join(files_dir, primary), f"{dir_to_grade}{submission}")
+    index.add(submission)
+
+    # the submission is graded from the top of its workspace, so a primary in a subfolder (src/main.c) has
+    # the rest of the files staged relative to that folder, that way its #include "util.h" still works
+    if (os.path.dirname(primary)):
+        files_dir = rebase_files(files_dir, os.path.dirname(primary))
+
+    if (list_files(files_dir)):
+        os.replace(files_dir, f"{dir_to_grade}{get_attachments_dir(submission)}")
+        index.add(get_attachments_dir(submission))
+
+    rmtree(download.temp_dir)
+    manifest[str(download.sub.user_id)] = dict(download.metadata, filename=submission)
+
+    return submission
+
+"""
+moves everything in files_dir under its sub folder primary_dir and returns that folder. files already in it
+stay where they are, everything else keeps its path from the top of files_dir, unless primary_dir already
+has a file there
+"""
+def rebase_files(files_dir, primary_dir):
+    new_root = join(files_dir, primary_dir)
+
+    for f in list_files(files_dir):
+        if (f.startswith(primary_dir + os.sep)):
+            continue
+
+        target = join(new_root, f)
+        if (not os.path.exists(target)):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(join(files_dir, f), target)
+
+    return new_root
+
+"""
+downloads new and updated submissions from Canvas, submissions that are the same as the last time they 
+were downloaded (according to the sync manifest) are skipped. the downloads run on a pool of threads 
+that share one session, is_primary and is_preferred are passed on to finish_download
+"""
+def download_submissions(assignment_id, dir_to_grade, regrade, workers=DOWNLOAD_WORKERS, index=None, is_primary=None, is_preferred=None):
+    if (not isdir(dir_to_grade)):
+        mkdir(dir_to_grade)
+
+    if (index is None):
+        index = Submission_Index(dir_to_grade)
+
+    manifest = load_manifest(dir_to_grade)
+
+    downloads, dont_grade = plan_downloads(assignment_id, dir_to_grade, regrade, manifest)
+
+    session = make_session(workers)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+
+        for download in downloads:
+            print(f"Downloading submission for {download.student_name}...")
+            futures[pool.submit(fetch_submission, session, download)] = download
+
+        failed = []
+
+        try:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # one student's bad download (or bad archive) doesn't stop everyone else from being downloaded
+                    print(f"Error: could not download the submission for {futures[future].student_name}: {e}")
+                    failed.append(futures[future])
+                    continue
+
+                if (finish_download(dir_to_grade, futures[future], index, manifest, is_primary, is_preferred) is None):
+                    failed.append(futures[future])
+
+            # nothing about a failed download is left in the manifest, so the next run tries it again
+            for download in failed:
+                manifest.pop(str(download.sub.user_id), None)
+        finally:
+            # whatever did get downloaded is remembered, even if a download failed
+            save_manifest(dir_to_grade, manifest)
+
+    session.close()
+
+    # whatever is still on disk for a failed download is an older attempt, so it isn't graded (its grade would
+    # go on the new attempt)
+    for download in failed:
+        dont_grade.extend(f"{dir_to_grade}{f}" for f in index.get(download.sub.user_id)
+                          if not isdir(f"{dir_to_grade}{f}"))
+
+    if (failed):
+        print(f"<!> {len(failed)} download(s) failed, run again to retry just those: {', '.join(d.student_name for d in failed)}")
 
     return dont_grade
 
@@ -108,32 +479,200 @@ removes non-alphanumeric characters from a student name and replaces them with d
 def remove_illegal_chars(name):
     return re.sub("[^0-9a-zA-Z]+", "-", name)
 
+# how many students' feedback and grades are uploaded at the same time
+UPLOAD_WORKERS = 4
+# uploads start slowing down once Canvas says there is less than this much left in the rate limit bucket
+RATE_LIMIT_THRESHOLD = 200
+# the longest an upload will wait for the rate limit bucket to refill
+MAX_THROTTLE_SECONDS = 5
+
 """
-attaches feedback files to submissions and grades them
+slows uploads down as the Canvas rate limit runs out. every response Canvas sends has an 
+X-Rate-Limit-Remaining header, this watches those through a hook on the canvasapi session
 """
-def attach_files_and_grade(assignment_id, csv_filename):
-    assignment = course.get_assignment(assignment_id)
+class Rate_Limiter:
+    def __init__(self):
+        self.remaining = None
+
+    # requests response hook
+    def update(self, response, *args, **kwargs):
+        remaining = response.headers.get("X-Rate-Limit-Remaining")
+        if (remaining is not None):
+            self.remaining = float(remaining)
+
+    # waits longer the closer to empty the bucket is
+    def wait(self):
+        remaining = self.remaining
+        if (remaining is not None and remaining < RATE_LIMIT_THRESHOLD):
+            time.sleep(MAX_THROTTLE_SECONDS * (RATE_LIMIT_THRESHOLD - max(remaining, 0)) / RATE_LIMIT_THRESHOLD)
 
-    grades_info = get_grade_info(csv_filename)
+# checks if an error from Canvas is worth trying again
+def is_transient(e):
+    import requests
+    from canvasapi.exceptions import CanvasException, Forbidden, RateLimitExceeded
 
-    for sub in assignment.get_submissions():
-        user_id = str(sub.user_id)
-        if user_id in grades_info:
-            print(f"Uploading feedback for {grades_info[user_id].student_name}...")
-            sub.upload_comment(grades_info[user_id].feedback_file)
-            sub.edit(submission={'posted_grade': int(grades_info[user_id].grade)})
+    if (isinstance(e, (RateLimitExceeded, requests.exceptions.ConnectionError, requests.exceptions.Timeout))):
+        return True
+    # Canvas sends its rate limit errors as a 403
+    if (isinstance(e, Forbidden)):
+        return "Rate Limit Exceeded" in str(e)
+    # canvasapi only raises the base exception for status codes it doesn't know, like 5xx
+    if (type(e) is CanvasException):
+        return "status code 5" in str(e)
+    return False
 
 """
-gets grading info from a result csv file
+calls into canvasapi, waiting on the rate limiter first and retrying with backoff on errors that aren't
+the request's fault
+"""
+def call_with_retries(limiter, func, *args, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.wait()
+
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if (attempt == MAX_RETRIES or not is_transient(e)):
+                raise
+            time.sleep(backoff(attempt))
+
+# the grade that is posted to Canvas for a score, weighted test cases can give partial points
+def get_posted_grade(score):
+    score = round(float(score), 2)
+    return int(score) if score.is_integer() else score
+
+"""
+uploads the feedback comment and then the grade for one student, skipping whatever was already uploaded. 
+what has been uploaded is saved in the results store after every step, in case the upload gets killed
+
+@params:
+    sub       - the student's Canvas submission
+    student   - the Student_Info to upload
+    store     - the results store
+    limiter   - the Rate_Limiter
+    unchanged - the steps ("comment" and/or "grade") Canvas already has, they are only marked as done
 """
-def get_grade_info(csv_filename):
-    info = {}
+def upload_submission(sub, student, store, limiter, unchanged=()):
+    # each step is saved with the Canvas attempt it was for, a resubmission has to get its own comment and grade
+    canvas_attempt = getattr(sub, "attempt", None)
+
+    try:
+        with phase("upload", student_id=str(sub.user_id)):
+            if (not store.is_uploaded(student.attempt_id, "comment")):
+                if ("comment" in unchanged):
+                    store.mark_uploaded(student.attempt_id, "comment", UNCHANGED, canvas_attempt)
+                else:
+                    print(f"Uploading feedback for {student.student_name}...")
+                    call_with_retries(limiter, sub.upload_comment, student.feedback_file)
+                    store.mark_uploaded(student.attempt_id, "comment", canvas_attempt=canvas_attempt)
+
+            if (not store.is_uploaded(student.attempt_id, "grade")):
+                if ("grade" in unchanged):
+                    store.mark_uploaded(student.attempt_id, "grade", UNCHANGED, canvas_attempt)
+                else:
+                    call_with_retries(limiter, sub.edit, submission={'posted_grade': get_posted_grade(student.grade)})
+                    store.mark_uploaded(student.attempt_id, "grade", canvas_attempt=canvas_attempt)
+    except Exception as e:
+        print(f"Error: could not upload feedback/grade for {student.student_name}: {e}")
+        store.record_upload_error(student.attempt_id, str(e))
+        return False
+
+    return True
+
+"""
+uploads feedback and grades for one run, it keeps an eye on the rate limit headers of every response 
+canvasapi gets while it is open
+
+@params:
+    assignment_id - the Canvas id of the assignment
+    dir_to_grade  - the directory to grade and download submissions to
+    store         - the results store, it keeps track of what has been uploaded
+"""
+class Grade_Uploader:
+    def __init__(self, assignment_id, dir_to_grade, store):
+        self.store = store
+        self.limiter = Rate_Limiter()
+        self.submissions = {str(sub.user_id): sub for sub in get_submissions(assignment_id, dir_to_grade)}
+        self.fetched_at = _fetched_at[assignment_id]
+        self.unchanged = 0
+        self.lock = Lock()
+
+    def __enter__(self):
+        get_course()._requester._session.hooks["response"].append(self.limiter.update)
+        return self
+
+    def __exit__(self, *exc):
+        get_course()._requester._session.hooks["response"].remove(self.limiter.update)
+
+        if (self.unchanged):
+            print(f"<!> {self.unchanged} upload(s) skipped, Canvas already had the same feedback and grade")
+
+    """
+    gets the steps of a student's upload that wouldn't change anything in Canvas. nothing uploaded for an
+    earlier Canvas attempt counts, a student that resubmits always gets a comment and grade on the new attempt.
+    the comment is unchanged if it is the same as the last feedback uploaded for them. the grade is unchanged if
+    it is the same as the score Canvas had when the submissions were fetched (and Canvas says that score is for
+    the current attempt), unless they were fetched before the last grade was uploaded for them, then it is
+    compared to that grade instead
+    """
+    def get_unchanged_steps(self, sub, student):
+        attempt = self.store.get_attempt(student.attempt_id)
+        canvas_attempt = getattr(sub, "attempt", None)
+        unchanged = []
+
+        last_comment = self.store.get_last_uploaded(student.id, "comment", student.attempt_id)
+        if (last_comment is not None and last_comment["canvas_attempt"] == canvas_attempt and 
+            last_comment["feedback_hash"] == attempt["feedback_hash"]):
+            unchanged.append("comment")
+
+        last_grade = self.store.get_last_uploaded(student.id, "grade", student.attempt_id)
+        if (last_grade is not None and last_grade["canvas_attempt"] != canvas_attempt):
+            return unchanged
+
+        if (last_grade is None or last_grade["uploaded_at"] < self.fetched_at):
+            canvas_score = getattr(sub, "score", None)
+            if (canvas_score is not None and getattr(sub, "grade_matches_current_submission", True) and 
+                float(canvas_score) == get_posted_grade(attempt["score"])):
+                unchanged.append("grade")
+        elif (get_posted_grade(last_grade["score"]) == get_posted_grade(attempt["score"])):
+            unchanged.append("grade")
+
+        return unchanged
+
+    # uploads one student's feedback and grade, returns whether it worked
+    def upload(self, student):
+        if (str(student.id) not in self.submissions):
+            print(f"Error: {student.student_name} ({student.id}) has no submission in Canvas")
+            return False
+
+        sub = self.submissions[str(student.id)]
+        unchanged = self.get_unchanged_steps(sub, student)
+
+        if (len(unchanged) == 2):
+            with self.lock:
+                self.unchanged += 1
+
+        return upload_submission(sub, student, self.store, self.limiter, unchanged)
+
+"""
+attaches feedback files to submissions and grades them, for every attempt in the results store that still
+needs to be uploaded. uploads run on a pool of threads, and progress is saved for each attempt so an 
+interrupted upload is picked up again by the next run
+"""
+def attach_files_and_grade(assignment_id, dir_to_grade, store, workers=UPLOAD_WORKERS):
+    pending = [Student_Info(a["student_name"], a["student_id"], a["score"], a["feedback_path"], a["id"]) 
+               for a in store.get_pending_uploads()]
+
+    if (not pending):
+        return
+
+    with Grade_Uploader(assignment_id, dir_to_grade, store) as uploader:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            uploads = [pool.submit(uploader.upload, student) for student in pending if student.id in uploader.submissions]
+            failed = [u for u in uploads if not u.result()]
 
-    with open(csv_filename, "r") as csvfile:
-        reader = csv.reader(csvfile, delimiter=",")
-        for row in reader:
-            info[row[1]] = Student_Info(row[0], row[1], row[2], row[3])
-    return info
+    if (failed):
+        print(f"<!> {len(failed)} upload(s) failed, run again to retry just those")
 
 if (__name__ == "__main__"):
     remove_old_submission("p1_canvas/", 176460)
\ No newline at end of file
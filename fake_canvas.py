@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+"""
+a stand-in for the parts of the Canvas API that canvas_utils uses, so downloading and uploading can be
+load tested without touching a real course. point canvas_utils at it by setting CANVAS_BASE_URL to the url
+it prints. it serves:
+    GET  /api/v1/courses/:course_id
+    GET  /api/v1/courses/:course_id/assignments/:assignment_id
+    GET  /api/v1/courses/:course_id/assignments/:assignment_id/submissions   (paginated with Link headers)
+    GET  /files/:file_id/download
+    POST /api/v1/courses/:course_id/assignments/:assignment_id/submissions/:user_id/comments/files
+    POST /uploads/:upload_id                                                   (where comment files are sent)
+    PUT  /api/v1/courses/:course_id/assignments/:assignment_id/submissions/:user_id
+    GET  /__stats                                                              (what the server has seen)
+every assignment has the same made up students, who all submitted the same files
+"""
+
+# the most submissions Canvas hands back in one page, and how many when per_page isn't given
+MAX_PAGE_SIZE     = 100
+DEFAULT_PAGE_SIZE = 10
+
+# Canvas' rate limit is a bucket that is refilled over time and emptied a little by every request
+RATE_LIMIT_BUCKET = 700.0
+RATE_LIMIT_REFILL = 10.0
+REQUEST_COST      = 1.0
+
+# each student's extra attachments get file ids this far apart from their first attachment's id
+EXTRA_FILE_ID_STEP = 1000000
+
+"""
+everything the server knows and has seen, shared between its request threads
+
+@params:
+    submissions - how many students have submitted to each assignment
+    attachment  - the bytes every student submitted
+    filename    - the name of every student's attachment
+    extra_attachments - (filename, bytes) for any other files every student submitted
+    latency     - seconds added to every response
+    jitter      - up to this many more seconds are added at random
+    throttle    - the chance a request gets a 429 with a Retry-After
+    failures    - the chance a request gets a 500 or 503
+    bucket      - the size of the rate limit bucket, the server sends a 403 (like Canvas does) when it's empty
+    refill      - how much the bucket refills every second
+"""
+class Fake_Canvas_State:
+    def __init__(self, submissions=50, attachment=b"int main() { return 0; }\n", filename="submission.c", latency=0.0, jitter=0.0,
+                 throttle=0.0, failures=0.0, bucket=RATE_LIMIT_BUCKET, refill=RATE_LIMIT_REFILL, extra_attachments=()):
+        self.submissions = submissions
+        self.attachments = [(filename, attachment)] + list(extra_attachments)
+        self.latency     = latency
+        self.jitter      = jitter
+        self.throttle    = throttle
+        self.failures    = failures
+        self.bucket      = bucket
+        self.refill      = refill
+
+        self.lock         = threading.Lock()
+        self.remaining    = bucket
+        self.refilled_at  = time.monotonic()
+        self.requests     = {}
+        self.errors       = {}
+        self.uploads      = {}
+        self.comments     = {}
+        self.grades       = {}
+        self.bytes_served = 0
+
+    # counts a request against an endpoint
+    def count(self, counter, endpoint):
+        with self.lock:
+            counter[endpoint] = counter.get(endpoint, 0) + 1
+
+    # takes the cost of a request out of the bucket, returns what is left (below 0 means throttled)
+    def spend(self):
+        with self.lock:
+            now = time.monotonic()
+            self.remaining = min(self.bucket, self.remaining + (now - self.refilled_at) * self.refill) - REQUEST_COST
+            self.refilled_at = now
+            return self.remaining
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests":     dict(self.requests),
+                "errors":       dict(self.errors),
+                "comments":     sum(len(c) for c in self.comments.values()),
+                "grades":       len(self.grades),
+                "bytes_served": self.bytes_served,
+            }
+
+    # the made up submission for a student, in the same shape Canvas sends with include[]=user
+    def submission(self, base_url, course_id, assignment_id, i):
+        user_id = 1000 + i
+
+        return {
+            "id":            i + 1,
+            "user_id":       user_id,
+            "assignment_id": assignment_id,
+            "course_id":     course_id,
+            "attempt":       1,
+            "score":         self.grades.get((assignment_id, user_id)),
+            "grade_matches_current_submission": True,
+            "submitted_at":  "2021-10-06T12:00:00Z",
+            "workflow_state": "submitted",
+            "user":          {"id": user_id, "name": f"Student {i}", "short_name": f"student{i}", "sortable_name": f"{i}, Student"},
+            "attachments":   [{
+                "id":           5000 + i + k * EXTRA_FILE_ID_STEP,
+                "display_name": filename,
+                "filename":     filename,
+                "size":         len(contents),
+                "url":          f"{base_url}files/{5000 + i + k * EXTRA_FILE_ID_STEP}/download",
+                "updated_at":   "2021-10-06T12:00:00Z",
+            } for k, (filename, contents) in enumerate(self.attachments)],
+        }
+
+# the api routes, the handler method for each is picked by the method and the name of the route
+ROUTES = [
+    ("course",        re.compile(r"^/api/v1/courses/(\d+)$")),
+    ("assignment",    re.compile(r"^/api/v1/courses/(\d+)/assignments/(\d+)$")),
+    ("submissions",   re.compile(r"^/api/v1/courses/(\d+)/assignments/(\d+)/submissions$")),
+    ("comment_file",  re.compile(r"^/api/v1/courses/(\d+)/assignments/(\d+)/submissions/(\d+)/comments/files$")),
+    ("submission",    re.compile(r"^/api/v1/courses/(\d+)/assignments/(\d+)/submissions/(\d+)$")),
+    ("file",          re.compile(r"^/files/(\d+)/download$")),
+    ("upload",        re.compile(r"^/uploads/(\d+)$")),
+    ("stats",         re.compile(r"^/__stats$")),
+]
+
+class Fake_Canvas_Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    # quiet, a load test would print thousands of lines
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    @property
+    def base_url(self):
+        return f"http://{self.headers.get('Host', '%s:%d' % self.server.server_address[:2])}/"
+
+    def handle_request(self, method):
+        url  = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        for name, pattern in ROUTES:
+            match = pattern.match(url.path)
+            if (match and hasattr(self, f"{method.lower()}_{name}")):
+                break
+        else:
+            return self.send_json(404, {"errors": [{"message": "The specified resource does not exist."}]})
+
+        self.state.count(self.state.requests, f"{method} {name}")
+
+        # the stats are for whoever is running the load test, so they are never slowed down or failed
+        if (name == "stats"):
+            return self.get_stats(query=parse_qs(url.query), body=body, remaining=None)
+
+        time.sleep(self.state.latency + random.uniform(0, self.state.jitter))
+
+        # files are up and downloaded straight to Canvas' file store, so they don't count against the rate limit
+        remaining = self.state.spend() if name not in ["file", "upload"] else None
+
+        # injected errors come before the request does anything, like a real overloaded server
+        if (remaining is not None and remaining < 0):
+            self.state.count(self.state.errors, "403 rate limit")
+            return self.send_text(403, "403 Forbidden (Rate Limit Exceeded)", remaining)
+        if (random.random() < self.state.throttle):
+            self.state.count(self.state.errors, "429")
+            return self.send_json(429, {"errors": [{"message": "Too Many Requests"}]}, remaining, {"Retry-After": "1"})
+        if (random.random() < self.state.failures):
+            status = random.choice([500, 503])
+            self.state.count(self.state.errors, str(status))
+            return self.send_json(status, {"errors": [{"message": "Internal Server Error"}]}, remaining)
+
+        getattr(self, f"{method.lower()}_{name}")(*match.groups(), query=parse_qs(url.query), body=body, remaining=remaining)
+
+    def get_stats(self, query, body, remaining):
+        self.send_json(200, self.state.stats())
+
+    def get_course(self, course_id, query, body, remaining):
+        self.send_json(200, {"id": int(course_id), "name": "Fake Course", "course_code": "FAKE 1000"}, remaining)
+
+    def get_assignment(self, course_id, assignment_id, query, body, remaining):
+        self.send_json(200, {"id": int(assignment_id), "course_id": int(course_id), "name": f"Assignment {assignment_id}"}, remaining)
+
+    def get_submissions(self, course_id, assignment_id, query, body, remaining):
+        per_page = min(int(query.get("per_page", [DEFAULT_PAGE_SIZE])[0]), MAX_PAGE_SIZE)
+        page     = int(query.get("page", ["1"])[0])
+        last     = max(1, -(-self.state.submissions // per_page))
+
+        first_index = (page - 1) * per_page
+        indexes     = range(first_index, min(first_index + per_page, self.state.submissions))
+        submissions = [self.state.submission(self.base_url, int(course_id), int(assignment_id), i) for i in indexes]
+
+        # the links keep every other part of the query (include[]=user, per_page, ...) just like Canvas
+        def link(page_number, rel):
+            link_query = "&".join(f"{k}={v}" for k, values in query.items() if k != "page" for v in values)
+            return f'<{self.base_url.rstrip("/")}{urlparse(self.path).path}?{link_query}&page={page_number}>; rel="{rel}"'
+
+        links = [link(page, "current"), link(1, "first"), link(last, "last")]
+        if (page < last):
+            links.append(link(page + 1, "next"))
+
+        self.send_json(200, submissions, remaining, {"Link": ",".join(links)})
+
+    def get_file(self, file_id, query, body, remaining):
+        k = int(file_id) // EXTRA_FILE_ID_STEP
+        if (k >= len(self.state.attachments)):
+            self.send_json(404, {"errors": [{"message": "The specified resource does not exist."}]}, remaining)
+            return
+
+        contents = self.state.attachments[k][1]
+        with self.state.lock:
+            self.state.bytes_served += len(contents)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents)
+
+    # the first step of uploading a comment file, Canvas says where to send the file
+    def post_comment_file(self, course_id, assignment_id, user_id, query, body, remaining):
+        params = parse_qs(body.decode(errors="replace"))
+
+        with self.state.lock:
+            upload_id = 9000 + len(self.state.uploads)
+            self.state.uploads[upload_id] = {"user_id": int(user_id), "name": params.get("name", ["feedback.txt"])[0], "size": None}
+
+        self.send_json(200, {"upload_url": f"{self.base_url}uploads/{upload_id}", "upload_params": {"filename": params.get("name", ["feedback.txt"])[0]}}, remaining)
+
+    # the file itself, this is a multipart post without any auth
+    def post_upload(self, upload_id, query, body, remaining):
+        upload_id = int(upload_id)
+
+        with self.state.lock:
+            if (upload_id not in self.state.uploads):
+                return self.send_json(404, {"errors": [{"message": "The specified resource does not exist."}]})
+            self.state.uploads[upload_id]["size"] = len(body)
+            name = self.state.uploads[upload_id]["name"]
+
+        self.send_json(201, {"id": upload_id, "display_name": name, "size": len(body), "url": f"{self.base_url}files/{upload_id}/download"})
+
+    # attaches uploaded comment files and posts grades
+    def put_submission(self, course_id, assignment_id, user_id, query, body, remaining):
+        params = parse_qs(body.decode(errors="replace"))
+        key    = (int(assignment_id), int(user_id))
+
+        with self.state.lock:
+            for file_id in params.get("comment[file_ids][]", []):
+                self.state.comments.setdefault(key, []).append(int(file_id))
+
+            if ("submission[posted_grade]" in params):
+                self.state.grades[key] = float(params["submission[posted_grade]"][0])
+
+        self.send_json(200, self.state.submission(self.base_url, int(course_id), int(assignment_id), int(user_id) - 1000), remaining)
+
+    def send_json(self, status, value, remaining=None, headers={}):
+        self.send_text(status, json.dumps(value), remaining, dict(headers, **{"Content-Type": "application/json"}))
+
+    def send_text(self, status, text, remaining=None, headers={}):
+        body = text.encode()
+
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        if (remaining is not None):
+            self.send_header("X-Rate-Limit-Remaining", f"{max(remaining, 0):.1f}")
+            self.send_header("X-Request-Cost", f"{REQUEST_COST:.1f}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+"""
+starts a fake Canvas on a background thread, the state options are the same as Fake_Canvas_State's.
+the returned server has the url to set CANVAS_BASE_URL to as server.url, and server.shutdown() stops it
+"""
+def start_fake_canvas(host="127.0.0.1", port=0, **options):
+    server = ThreadingHTTPServer((host, port), Fake_Canvas_Handler)
+    server.daemon_threads = True
+    server.state = Fake_Canvas_State(**options)
+    server.url = f"http://{host}:{server.server_address[1]}/"
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# gets the arguments for the program
+def get_args():
+    parser = argparse.ArgumentParser(description="A fake Canvas server for load testing canvas_utils")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="The address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="The port to listen on")
+    parser.add_argument("--submissions", type=int, default=50, help="How many students have submitted to each assignment")
+    parser.add_argument("--attachment", type=str, action="append", help="A file every student submitted (can be given more than once), a tiny C program by default")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many more seconds are added at random")
+    parser.add_argument("--throttle", type=float, default=0.0, help="The chance (0-1) a request gets a 429")
+    parser.add_argument("--failures", type=float, default=0.0, help="The chance (0-1) a request gets a 500 or 503")
+    parser.add_argument("--bucket", type=float, default=RATE_LIMIT_BUCKET, help="The size of the rate limit bucket")
+    parser.add_argument("--refill", type=float, default=RATE_LIMIT_REFILL, help="How much the rate limit bucket refills every second")
+    return parser.parse_args()
+
+# main
+if (__name__ == "__main__"):
+    args = get_args()
+    options = {}
+
+    if (args.attachment):
+        attachments = []
+        for filename in args.attachment:
+            with open(filename, "rb") as f:
+                attachments.append((filename.split("/")[-1], f.read()))
+
+        options.update(filename=attachments[0][0], attachment=attachments[0][1], extra_attachments=attachments[1:])
+
+    server = start_fake_canvas(args.host, args.port, submissions=args.submissions, latency=args.latency, jitter=args.jitter,
+                               throttle=args.throttle, failures=args.failures, bucket=args.bucket, refill=args.refill, **options)
+
+    print(f"Fake Canvas running, use it with:\n    CANVAS_BASE_URL={server.url} COURSE_ID=1 CANVAS_API_KEY=fake")
+
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import threading
+
+from shutil import copy
+
+# all the caches live in this directory inside of the dir to grade
+CACHE_DIR_NAME = ".cache"
+
+# file hashes for this process, keyed on (path, size, mtime) so the reference exe is only hashed once
+_file_hashes = {}
+
+"""
+gets the cache directory for the dir to grade, or None if caching is turned off
+"""
+def get_cache_dir(dir_to_grade, use_cache=True):
+    if (not use_cache):
+        return None
+    return os.path.join(dir_to_grade, CACHE_DIR_NAME)
+
+# hashes the contents of a file
+def hash_file(filename):
+    stat = os.stat(filename)
+    stamp = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+    if (stamp not in _file_hashes):
+        file_hash = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                file_hash.update(chunk)
+        _file_hashes[stamp] = file_hash.hexdigest()
+
+    return _file_hashes[stamp]
+
+"""
+builds a cache key out of the contents of some files and any other values that change the result
+(args, compilers, etc), the names of the files don't matter, only what is in them
+
+@params:
+    files  - the files whose contents are part of the key
+    extras - anything else that is part of the key, must be json serializable
+"""
+def make_key(files, extras=None):
+    key = hashlib.sha256()
+
+    for f in files:
+        key.update(hash_file(f).encode())
+    key.update(json.dumps(extras, sort_keys=True, default=str).encode())
+
+    return key.hexdigest()
+
+# gets the path to an entry in the cache
+def cache_path(cache_dir, kind, key):
+    return os.path.join(cache_dir, kind, key)
+
+"""
+copies a cached file to dest, returns False if there is nothing cached for this key
+"""
+def load_cached_file(cache_dir, kind, key, dest):
+    if (not cache_dir or not os.path.isfile(cache_path(cache_dir, kind, key))):
+        return False
+
+    copy(cache_path(cache_dir, kind, key), dest)
+    return True
+
+# gets where an entry is written before it is moved into place, every process and thread writing the same entry
+# (like two test cases with the same reference output) gets its own
+def get_temp_path(entry):
+    return f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+"""
+puts a copy of a file in the cache, the file is copied next to its final spot and then renamed so
+a worker reading the cache never sees half of a file
+"""
+def store_cached_file(cache_dir, kind, key, src):
+    if (not cache_dir):
+        return
+
+    entry = cache_path(cache_dir, kind, key)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+    temp = get_temp_path(entry)
+    copy(src, temp)
+    os.replace(temp, entry)
+
+# gets a cached json value, or None if there is nothing cached for this key
+def load_cached_value(cache_dir, kind, key):
+    if (not cache_dir or not os.path.isfile(cache_path(cache_dir, kind, key))):
+        return None
+
+    with open(cache_path(cache_dir, kind, key)) as f:
+        return json.load(f)
+
+# puts a json value in the cache
+def store_cached_value(cache_dir, kind, key, value):
+    if (not cache_dir):
+        return
+
+    entry = cache_path(cache_dir, kind, key)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+    temp = get_temp_path(entry)
+    with open(temp, "w") as f:
+        json.dump(value, f)
+    os.replace(temp, entry)
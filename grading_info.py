@@ -1,3 +1,10 @@
+import math
+
+from run_limits import LIMITS
+
+# how much output a student's program can print before it is killed, unless the json file says otherwise
+DEFAULT_MAX_OUTPUT_BYTES = 64 * 1024 * 1024
+
 # class that contains and validates info from the info json file
 class Grading_Info:
     def __init__(self, json_filename, json_file):
@@ -37,11 +44,39 @@ class Grading_Info:
         else:
             self.timeout = 30
 
+        # optional, the most bytes of output a student's program can print before it is stopped
+        self.max_output_bytes = DEFAULT_MAX_OUTPUT_BYTES
+
+        if "max_output_bytes" in json_file:
+            self.max_output_bytes = get_value_from_json("max_output_bytes", json_file, json_filename)
+
+        # optional, resource limits for every run of a student's program, see Run_Limits for what can be set
+        self.limits = {}
+
+        if "limits" in json_file:
+            self.limits = get_value_from_json("limits", json_file, json_filename)
+
+            for limit in self.limits:
+                if (limit not in LIMITS):
+                    print(f"Error: '{limit}' in 'limits' in {json_filename} is not a limit, it should be one of {', '.join(LIMITS)}")
+                    exit(1)
+
         if self.interpreted or self.compiled:
             self.stdin           = get_value_from_json("stdin", json_file, json_filename)
             self.stdout          = get_value_from_json("stdout", json_file, json_filename)
             self.points_per_line = get_value_from_json("points_per_line", json_file, json_filename)
 
+            # optional, sends all of the input to one process and splits the output on the record delimiter
+            # instead of starting a new process for every line of input
+            self.batch_stdin      = False
+            self.record_delimiter = "\n"
+
+            if "batch_stdin" in json_file:
+                self.batch_stdin = get_value_from_json("batch_stdin", json_file, json_filename)
+
+            if "record_delimiter" in json_file:
+                self.record_delimiter = get_value_from_json("record_delimiter", json_file, json_filename)
+
     def get_external_grading_info(self, json_filename, json_file):
         self.build_step_command   = get_value_from_json("build_step_command", json_file, json_filename)
         self.compile_step_command = get_value_from_json("compile_step_command", json_file, json_filename)
@@ -51,6 +86,12 @@ class Grading_Info:
         self.files_to_upload      = get_value_from_json("files_to_upload", json_file, json_filename)
         self.required_files       = get_value_from_json("required_files", json_file, json_filename)
 
+        # optional, configures and builds the driver once per worker instead of once per student
+        self.shared_build = False
+
+        if "shared_build" in json_file:
+            self.shared_build = get_value_from_json("shared_build", json_file, json_filename)
+
     # gets info for prolog assignments
     def get_prolog_info(self, json_filename, json_file):
         # TODO coming soon, prolog support
@@ -70,11 +111,78 @@ class Grading_Info:
         self.reference_exe        = get_value_from_json("reference_exe", json_file, json_filename)
         self.reference_exe_output = get_value_from_json("reference_exe_output", json_file, json_filename)
 
+        # optional, extra flags passed to the compiler before the submission
+        self.compiler_flags = []
+
+        if "compiler_flags" in json_file:
+            self.compiler_flags = get_value_from_json("compiler_flags", json_file, json_filename)
+
+        # optional, how many test inputs to generate up front (seeded 0 to n-1), or the exact seeds to use
+        self.test_bank_size  = 1
+        self.generator_seeds = []
+
+        if "test_bank_size" in json_file:
+            self.test_bank_size = get_value_from_json("test_bank_size", json_file, json_filename)
+
+        if "generator_seeds" in json_file:
+            self.generator_seeds = get_value_from_json("generator_seeds", json_file, json_filename)
+
         self.reference_exe_args = []
         self.student_exe_args   = []
 
+        # optional, a suite of named, weighted test cases that each get their own input, args and timeout
+        self.test_cases = []
+
+        if "test_cases" in json_file:
+            self.test_cases = get_test_cases(json_filename, json_file)
+
        
 
+# what each field of a test case defaults to when it is left out, a case with no input runs the generator
+TEST_CASE_DEFAULTS = {"input": None, "seed": None, "args": [], "timeout": None, "smoke": False}
+
+"""
+reads and checks the test cases for a compiled assignment. each case is scored out of its weight, so the
+weights have to add up to the total points:
+        "test_cases": [
+            {"name": "small", "weight": 5, "generator_args": ["10"]},  - the generator is run with these args
+            {"name": "seeded", "weight": 5, "seed": 42},               - or with a seed, see generator_seeds
+            {"name": "edge", "weight": 10, "input": "edge.txt",        - or the input is a file next to gradingtools.py
+             "args": ["-v"], "timeout": 10}                            - args go to both the reference and the student's
+        ]                                                                program, the timeout replaces the assignment's
+a case with "smoke": true is part of the smoke tier, which is run before every other case. it should be small with
+a short timeout, if the student's program crashes, times out or goes over a limit on it the rest of the cases aren't
+run and get a 0
+"""
+def get_test_cases(json_filename, json_file):
+    test_cases = []
+
+    for case in get_value_from_json("test_cases", json_file, json_filename):
+        name = case.get("name")
+
+        if (not isinstance(name, str) or not name or name.startswith(".") or "/" in name):
+            print(f"Error: every test case in {json_filename} needs a 'name' that can be used as a directory name")
+            exit(1)
+        if (name in [c["name"] for c in test_cases]):
+            print(f"Error: there is more than one test case named '{name}' in {json_filename}")
+            exit(1)
+        if (not isinstance(case.get("weight"), (int, float))):
+            print(f"Error: test case '{name}' in {json_filename} needs a 'weight'")
+            exit(1)
+        if ("input" in case and "generator_args" in case):
+            print(f"Error: test case '{name}' in {json_filename} has both an 'input' and 'generator_args', it can only have one")
+            exit(1)
+
+        test_cases.append(dict(TEST_CASE_DEFAULTS, **case))
+
+    total_points = get_value_from_json("total_points", json_file, json_filename)
+    # weights like 3.33 don't add up to exactly 10 as floats, so they only have to match to the hundredth
+    if (test_cases and not math.isclose(sum(c["weight"] for c in test_cases), total_points, abs_tol=0.005)):
+        print(f"Error: the test case weights in {json_filename} add up to {round(sum(c['weight'] for c in test_cases), 2)}, not the total_points ({total_points})")
+        exit(1)
+
+    return test_cases
+
 """
 gets values from a given json file
 """
@@ -6,23 +6,51 @@ import os.path
 import json
 import re
 import argparse
+import io
+import zlib
+import tempfile
+import signal
+import threading
+import contextvars
+import asyncio
+import time
 import subprocess as sp
 from os import path
-from shutil import copy, rmtree
-
-from canvas_utils import download_submissions, attach_files_and_grade
-from grading_info import Grading_Info, get_value_from_json
+from shutil import copy, copytree, rmtree
+from itertools import chain, repeat, zip_longest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from canvas_utils import (download_submissions, attach_files_and_grade, plan_downloads, fetch_submission, finish_download, make_session,
+                          load_manifest, save_manifest, Grade_Uploader, Student_Info, DOWNLOAD_WORKERS, UPLOAD_WORKERS)
+from grading_info import Grading_Info, get_value_from_json, DEFAULT_MAX_OUTPUT_BYTES
+from submission_index import Submission_Index, parse_student_id, get_attachments_dir
+from results_store import Results_Store
+from run_limits import Run_Limits, Run_Usage, get_exit_reason
+from run_trace import phase, start_trace
+from staging import staging, get_workspace, stage_shared_file, finish_workspace, STAGING_BACKENDS
+from archives import list_files
+from grading_cache import get_cache_dir, hash_file, make_key, load_cached_file, store_cached_file, load_cached_value, store_cached_value
 
 """
 run a given test case generator, if the generator is a python file, it should have a shebang and 'x' permissions so
 it can be run with './'
 """
-def poke_generator(data, generator_filename):
+def poke_generator(data, generator_filename, cwd=None, seed=None):
     process = None
+    env = None
+
+    # seeded generators get the seed through their environment, and in place of any "{seed}" in their args
+    if (seed is not None):
+        env = dict(os.environ, GRADING_SEED=str(seed))
+
     if ("generator_args" not in data):
-        process = sp.run([f"./{generator_filename}"], check=False, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE)
+        process = sp.run([os.path.join(".", generator_filename)], check=False, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE, cwd=cwd, env=env)
     else:
-        process = sp.run([f"./{generator_filename}"] + data["generator_args"], check=False, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE)
+        generator_args = data["generator_args"]
+        if (seed is not None):
+            generator_args = [str(a).replace("{seed}", str(seed)) for a in generator_args]
+
+        process = sp.run([os.path.join(".", generator_filename)] + generator_args, check=False, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE, cwd=cwd, env=env)
 
     try:
         process.check_returncode()
@@ -31,6 +59,97 @@ def poke_generator(data, generator_filename):
         print(f"Error: Generator '{generator_filename}' returned a non-zero exit code:\nGenerator stderr:\n\n{error}")
         exit(1)
 
+# generated test inputs are kept in this directory inside of the dir to grade
+TEST_BANK_DIR = ".test_bank"
+
+"""
+runs the generator once per seed, up front, to build a bank of test inputs. with no seeds the generator is just
+run once, unseeded. every submission is graded with an input from this bank instead of running the generator again
+
+@params:
+    info         - the grading info object
+    json_file    - the json file object
+    dir_to_grade - the directory to grade and download submissions to
+"""
+def build_test_bank(info, json_file, dir_to_grade):
+    if (info.test_cases):
+        return build_case_inputs(info, dir_to_grade)
+
+    if (info.generator_seeds):
+        seeds = info.generator_seeds
+    elif (info.test_bank_size > 1):
+        seeds = list(range(info.test_bank_size))
+    else:
+        seeds = [None]
+
+    test_bank = []
+
+    for i, seed in enumerate(seeds):
+        print(f"Running {info.generator}{'' if seed is None else f' (seed {seed})'}...", end=" ")
+        with phase("generator", seed=seed):
+            poke_generator(json_file, info.generator, seed=seed)
+
+        bank_entry = os.path.join(dir_to_grade, TEST_BANK_DIR, str(i))
+        os.makedirs(bank_entry, exist_ok=True)
+        copy(info.generator_output, bank_entry)
+
+        test_bank.append(os.path.join(bank_entry, info.generator_output))
+
+        # give some info about the generator output
+        print(f"{len(open(test_bank[-1]).readlines())} lines generated")
+
+    return test_bank
+
+"""
+gets the input for every test case up front, in the same order as the test cases. a case either has its own
+input file, or the generator is run with the case's args and seed. every input is saved under the generator
+output's name, since that is the file the reference and the student's program read
+"""
+def build_case_inputs(info, dir_to_grade):
+    case_inputs = []
+
+    for case in info.test_cases:
+        case_dir = os.path.join(dir_to_grade, TEST_BANK_DIR, CASES_DIR, case["name"])
+        os.makedirs(case_dir, exist_ok=True)
+
+        if (case["input"] is not None):
+            print(f"Using {case['input']} for test case {case['name']}...", end=" ")
+            copy(case["input"], os.path.join(case_dir, info.generator_output))
+        else:
+            print(f"Running {info.generator} for test case {case['name']}...", end=" ")
+            with phase("generator", case=case["name"]):
+                poke_generator(case, info.generator, seed=case["seed"])
+            copy(info.generator_output, case_dir)
+
+        case_inputs.append(os.path.join(case_dir, info.generator_output))
+        print(f"{len(open(case_inputs[-1]).readlines())} lines")
+
+    return case_inputs
+
+# picks the input from the test bank for a student, the same student always gets the same input
+def pick_test_input(test_bank, student_id):
+    return test_bank[zlib.crc32(student_id.encode()) % len(test_bank)]
+
+"""
+the result of grading one submission, usage is the Run_Usage summary for the student's runs. the duration
+is how long grading took (None when the result came from the cache, so it doesn't count as the submission's
+runtime) and the attempt id is the result's row in the results store, once it is in there
+"""
+class Grade_Result:
+    def __init__(self, student_name, student_id, sub_file, score, note="", usage=None):
+        self.student_name = student_name
+        self.student_id = student_id
+        self.sub_file = sub_file
+        self.score = score
+        self.note = note
+        self.usage = usage if usage else Run_Usage().summary()
+        self.duration = 0.0
+        self.attempt_id = None
+        self.cached = False
+
+    def feedback_path(self, dir_to_grade):
+        return f"{dir_to_grade}{self.sub_file}/{self.student_name}.results.txt"
+
 """
 kicks off all the grading 
 """
@@ -57,6 +176,10 @@ def grade(args):
         print("<!> Forcefully regarding! All student's latest submissions will be dowloaded and regraded!\n")
         regrade = True
 
+    # every phase of the run is timed and written to the trace file
+    if (args.trace):
+        start_trace(args.trace)
+
     # gets the directory to put the submissions in
     dir_to_grade = f"{os.getcwd()}/{args.directory}"
 
@@ -87,6 +210,9 @@ def grade(args):
         exit(1) 
 
     timeout = info.timeout
+
+    # a submission's test cases run on whatever cores the other worker processes leave over
+    case_jobs = args.case_jobs or max(1, (os.cpu_count() or 1) // args.jobs)
     
     if info.external:
         # makes sure all the files required for grading exist
@@ -103,47 +229,60 @@ def grade(args):
     
     dont_grade = []
 
-    # downloads all the submissions and gets the submissions that shouldn't be graded
-    # this is the case with submissions that have not been updated since the last run
-    # this won't be run if you are running on local files only
-    if not args.local:
-        dont_grade = download_submissions(assignment_id, dir_to_grade, regrade)
-    
-    for i in range(len(dont_grade)):
-        dont_grade[i] = dont_grade[i].split("/")[-1]
-    
-    # store the current directory
-    orig_dir = os.getcwd()
-    # move into the directory to start grading
-    os.chdir(dir_to_grade)
+    # the dir to grade is only listed once, everything after this looks submissions up in the index
+    index = Submission_Index(dir_to_grade)
+
+    # every result is saved in the results store as soon as it is graded
+    store = Results_Store(dir_to_grade)
+    store.start_run(json_filename, upload=not (debug or args.local))
+
+    # the test inputs are generated once for the whole run
+    test_bank = build_test_bank(info, json_file, dir_to_grade) if info.compiled else []
+
+    # there is nothing to download or upload when grading locally, so there is nothing to pipeline either
+    pipelined = args.pipeline and not args.local
+
+    if pipelined:
+        total_submissions, results = grade_pipelined(info, dir_to_grade, assignment_id, index, store, regrade, not debug, test_bank, 
+                                                     json_file, json_filename, timeout, args.jobs, case_jobs, not args.no_cache)
+    else:
+        # downloads all the submissions and gets the submissions that shouldn't be graded
+        # this is the case with submissions that have not been updated since the last run
+        # this won't be run if you are running on local files only
+        if not args.local:
+            dont_grade = download_submissions(assignment_id, dir_to_grade, regrade, index=index,
+                                              is_primary=lambda f: is_submission(info, dir_to_grade, f),
+                                              is_preferred=lambda f: is_source_file(info, f))
+        
+        dont_grade = set(d.split("/")[-1] for d in dont_grade)
 
-    # create the result file
-    result_csv = open("results.csv", "w+")
+        # every submission is graded inside of its own directory, so nothing here depends on the cwd
+        total_submissions, results = grade_submissions(info, dir_to_grade, index, store, dont_grade, test_bank, json_file, json_filename, timeout, 
+                                                       args.jobs, case_jobs, not args.no_cache)
 
     # summary variables
-    total_submissions = graded_submissions = scores_for_avg = 0
+    graded_submissions = len(results)
+    scores_for_avg     = sum(r.score for r in results)
 
-    if info.compiled:
-        results = grade_compiled(info, dir_to_grade, dont_grade, orig_dir, json_file, json_filename, result_csv, timeout)
-    elif info.interpreted:
-        results = grade_interpreted(info, dir_to_grade, dont_grade, result_csv, timeout)
-    elif info.external:
-        results = grade_external(info, dir_to_grade, dont_grade, result_csv, timeout)
+    # the shared build trees are only good for this run
+    if (info.external and info.shared_build and os.path.isdir(f"{dir_to_grade}{SHARED_BUILD_DIR}")):
+        rmtree(f"{dir_to_grade}{SHARED_BUILD_DIR}")
 
-    total_submissions  += results[0]
-    graded_submissions += results[1]
-    scores_for_avg     += results[2] 
-    
-    result_csv.close()
+    # results.csv is still written for anything that reads it, it is exported from the results store
+    store.export_csv(f"{dir_to_grade}results.csv")
 
     if not debug:
+        # uploads whatever hasn't been uploaded yet, a pipelined run has already uploaded everything it could
+        # as it was graded, so this only retries its failures and anything left over from an earlier run
         if not args.local:
-            attach_files_and_grade(assignment_id, "results.csv")
+            attach_files_and_grade(assignment_id, dir_to_grade, store)
         
         print(f"""Finished!\nGrades have been updated in Canvas and feedback has been uploaded\n
               Check {dir_to_grade}results.csv for grades""")
     else:
         print(f"Finished!\nCheck {dir_to_grade}results.csv for grades")
+
+    store.finish_run()
     
     # shows stats for run
     print(f"\nStats:")
@@ -152,321 +291,790 @@ def grade(args):
     if graded_submissions > 0:
         print(f"Average Score (for new/updated): {scores_for_avg/graded_submissions}/{info.total_points}")
 
-def grade_external(info, dir_to_grade, dont_grade, result_csv, timeout):
-    total_submissions = graded_submissions = scores_for_avg = 0
+    if (args.trace):
+        print(f"\nTrace written to {args.trace}, run 'run_trace.py {args.trace}' for a summary")
+
+"""
+checks if a file in the dir to grade is a student submission for the kind of assignment being graded
+
+@params:
+    info         - the grading info object
+    dir_to_grade - the directory to grade and download submissions to
+    submission   - the name of the file to check
+"""
+def is_submission(info, dir_to_grade, submission):
+    # hidden files belong to the grader (manifests, caches, etc)
+    if (submission.startswith(".") or ".txt" in submission or ".csv" in submission or 
+        os.path.isdir(os.path.join(dir_to_grade, submission))):
+        return False
+
+    if info.compiled:
+        return submission != info.generator_output and submission not in info.reference_exe
+    elif info.interpreted:
+        return submission not in info.required_files and submission != info.reference_solution
     
-    for submission in os.listdir(os.getcwd()):
-        score = 0
+    return submission not in info.required_files
 
-        if (submission not in info.required_files and ".txt" not in submission and ".csv" not in submission and 
-            not os.path.isdir(os.path.join(os.getcwd(), submission))):
-            total_submissions += 1
-            
-            if submission in dont_grade:
-                continue
-            
-            graded_submissions += 1
+# the source file extensions each compiler builds, a compiler that isn't in here has no preferred extension
+SOURCE_EXTENSIONS = {
+    "gcc":   (".c",),
+    "clang": (".c",),
+    "ghc":   (".hs",),
+    "fpc":   (".pas", ".pp"),
+}
+
+"""
+checks if a file looks like the student's source for the assignment, this is used to pick which file in an
+archive gets graded: the student_filename for external assignments, a file the compiler builds for compiled
+ones and a file with the same extension as the reference solution for interpreted ones
+"""
+def is_source_file(info, filename):
+    if info.compiled:
+        return filename.lower().endswith(SOURCE_EXTENSIONS.get(os.path.basename(info.compiler), ()))
+    elif info.interpreted:
+        return os.path.splitext(filename)[1] == os.path.splitext(info.reference_solution)[1]
+
+    return filename == info.student_filename
 
-            # submissions are in this format: 
-            #           <pid>_<canvas id>_<assignment id>_<submission name>.<file extension>
-            #           jamesw98_1234_4242_p2.hs
-            sub_split = submission.split("_")
-            sub_file = submission.split(".")[0]
-            student_id = sub_split[1]
-            student_name = sub_split[0]
+"""
+grades every submission in the dir to grade, either one at a time or on a pool of worker processes
 
-            # if there is not already a directory for this student, create one
-            if (not os.path.isdir(sub_file)):
-                os.mkdir(sub_file)
+@params:
+    info          - the grading info object
+    dir_to_grade  - the directory to grade and download submissions to
+    index         - the submission index for the dir to grade
+    dont_grade    - a set of submissions to skip over, usually unchanged submissions
+    test_bank     - the generated test inputs
+    json_file     - the json file object
+    json_filename - the filename for the json file
+    timeout       - the timeout for each run of a student's program
+    jobs          - the number of submissions to grade at the same time
+    case_jobs     - the number of test cases of one submission to run at the same time
+    use_cache     - whether or not cached reference outputs can be used
+"""
+def grade_submissions(info, dir_to_grade, index, store, dont_grade, test_bank, json_file, json_filename, timeout, jobs, case_jobs, use_cache):
+    submissions = sorted(s for s in index.files() if is_submission(info, dir_to_grade, s))
+    to_grade    = shortest_first([s for s in submissions if s not in dont_grade], store.get_durations())
 
-            copy(submission, f"{sub_file}/")
+    grader, extra_args = get_grader(info, test_bank, json_file, json_filename, case_jobs)
 
-            for f in info.required_files:
-                copy(f, f"{sub_file}/")
+    results = {}
+
+    if (jobs > 1):
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(grade_submission, grader, info, dir_to_grade, s, timeout, use_cache, test_bank, *extra_args): s for s in to_grade}
             
-            os.chdir(f"{sub_file}/")
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                record_result(store, dir_to_grade, results[futures[future]])
+                print_result(info, results[futures[future]])
+    else:
+        for s in to_grade:
+            results[s] = grade_submission(grader, info, dir_to_grade, s, timeout, use_cache, test_bank, *extra_args)
+            record_result(store, dir_to_grade, results[s])
+            print_result(info, results[s])
 
-            print(f"Grading {student_name}'s submission...", end=" ")
+    # results are handed back in the same order a sequential run would have graded them in
+    return (len(submissions), [results[s] for s in to_grade])
 
-            # creates an output result file for this submission 
-            output_file = open(f"{student_name}.results.txt", "w")
+"""
+orders submissions by how long each student's last attempt took to grade, shortest first, so most results come
+back early and the slowest submissions (usually the ones that time out) don't hold up the rest. submissions
+with no attempts yet are guessed to take as long as the median attempt
 
-            os.rename(submission, info.student_filename)
+@params:
+    submissions - the submissions, or anything else that belongs to a student
+    durations   - how long each student's last attempt took, see Results_Store.get_durations
+    student_id  - gets the student's Canvas id for a submission
+"""
+def shortest_first(submissions, durations, student_id=parse_student_id):
+    known = sorted(durations.values())
+    guess = known[len(known) // 2] if known else 0
+    return sorted(submissions, key=lambda s: durations.get(str(student_id(s)), guess))
 
-            run_cmd(info.build_step_command, [], timeout)
-            compile_result = run_cmd(info.compile_step_command, [], timeout)
+# gets the function that grades this kind of submission, and any other args it needs
+def get_grader(info, test_bank, json_file, json_filename, case_jobs=1):
+    if info.compiled:
+        return (grade_compiled_submission, (test_bank, json_file, json_filename, case_jobs))
+    elif info.interpreted:
+        return (grade_interpreted_submission, ())
+    elif info.external:
+        return (grade_external_submission, ())
 
-            if not compile_result[0]:
-                output_file.write(f"Your submission did not compile. See compiler output below\nYour score: 0/{info.total_points}\n\nCompiler Output:\n")
-                output_file.write(compile_result[1])
+# how many submissions can be waiting between two stages of the pipeline, for each worker of the later stage
+PIPELINE_QUEUE_SIZE = 2
 
-                if (os.path.isdir(os.path.join(os.getcwd(), "CMakeFiles/"))):
-                    rmtree(os.path.join(os.getcwd(), "CMakeFiles/"))
-                elif (os.path.isdir(os.path.join(os.getcwd(), "build/"))):
-                    rmtree(os.path.join(os.getcwd(), "build/"))
+"""
+downloads, grades and uploads submissions as a pipeline. each submission is graded as soon as it has been 
+downloaded and uploaded as soon as it has been graded, so a run takes about as long as its slowest stage 
+instead of all three added up. the stages are joined by bounded queues, so a slow stage holds back the ones 
+before it instead of letting work pile up
 
-                os.chdir(dir_to_grade)
-                print("[0/100] <!> Didn't compile\n")
-                result_csv.write(f"{student_name},{student_id},{score},{dir_to_grade}{sub_file}/{student_name}.results.txt\n")
-                continue
+@params:
+    info          - the grading info object
+    dir_to_grade  - the directory to grade and download submissions to
+    assignment_id - the Canvas id of the assignment
+    index         - the submission index for the dir to grade
+    store         - the results store, every result is saved in it as soon as it is graded
+    regrade       - whether submissions that haven't changed still get graded
+    upload        - whether grades and feedback are uploaded (they aren't in debug mode)
+    test_bank     - the generated test inputs
+    jobs          - the number of submissions to grade at the same time
+    case_jobs     - the number of test cases of one submission to run at the same time
+"""
+def grade_pipelined(info, dir_to_grade, assignment_id, index, store, regrade, upload, test_bank, json_file, json_filename, timeout, jobs, case_jobs, use_cache):
+    return asyncio.run(run_pipeline(info, dir_to_grade, assignment_id, index, store, regrade, upload, test_bank, 
+                                    json_file, json_filename, timeout, max(jobs, 1), case_jobs, use_cache))
+
+async def run_pipeline(info, dir_to_grade, assignment_id, index, store, regrade, upload, test_bank, json_file, json_filename, timeout, jobs, case_jobs, use_cache):
+    loop = asyncio.get_running_loop()
+    grader, extra_args = get_grader(info, test_bank, json_file, json_filename, case_jobs)
+
+    grade_queue  = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE * jobs)
+    upload_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE * UPLOAD_WORKERS)
+
+    results = {}
+    failed_downloads = []
+
+    with ProcessPoolExecutor(max_workers=jobs) as processes, ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS + UPLOAD_WORKERS) as threads:
+        # the grading workers are forked before any other thread starts, a fork while another thread holds a
+        # lock (like the one on stdout) can leave the worker stuck on it forever
+        processes.submit(os.getpid).result()
+
+        manifest = load_manifest(dir_to_grade)
+        downloads, dont_grade = await loop.run_in_executor(threads, plan_downloads, assignment_id, dir_to_grade, regrade, manifest)
+
+        dont_grade  = set(d.split("/")[-1] for d in dont_grade)
+        downloading = set(str(d.sub.user_id) for d in downloads)
+
+        # submissions are graded shortest first, downloads are started in that order too since each one is
+        # graded as soon as it is done
+        durations = store.get_durations()
+        downloads = shortest_first(downloads, durations, lambda d: d.sub.user_id)
+
+        # only one download per thread is in flight or waiting on the grade queue at a time
+        download_slots = asyncio.Semaphore(DOWNLOAD_WORKERS)
+        session = make_session(DOWNLOAD_WORKERS)
+
+        async def queue_for_grading(submission):
+            if (submission not in dont_grade and is_submission(info, dir_to_grade, submission)):
+                await grade_queue.put(submission)
+
+        async def download(d):
+            async with download_slots:
+                print(f"Downloading submission for {d.student_name}...")
+
+                try:
+                    await loop.run_in_executor(threads, fetch_submission, session, d)
+                except Exception as e:
+                    print(f"Error: could not download the submission for {d.student_name}: {e}")
+                    failed_downloads.append(d)
+                    return
+
+                # the dir to grade and the index are only touched from the event loop's thread
+                submission = finish_download(dir_to_grade, d, index, manifest, lambda f: is_submission(info, dir_to_grade, f),
+                                             lambda f: is_source_file(info, f))
+                if (submission is not None):
+                    await queue_for_grading(submission)
+
+        async def download_stage():
+            try:
+                # submissions that are already here and still need grading don't wait on any downloads
+                for submission in shortest_first(sorted(index.files()), durations):
+                    if (parse_student_id(submission) not in downloading):
+                        await queue_for_grading(submission)
+
+                await asyncio.gather(*(download(d) for d in downloads))
+            finally:
+                save_manifest(dir_to_grade, manifest)
+                session.close()
+
+            for _ in range(jobs):
+                await grade_queue.put(None)
+
+        async def grade_worker():
+            while True:
+                submission = await grade_queue.get()
+                if (submission is None):
+                    return
+
+                results[submission] = await loop.run_in_executor(processes, grade_submission, grader, info, dir_to_grade, 
+                                                                 submission, timeout, use_cache, test_bank, *extra_args)
+                record_result(store, dir_to_grade, results[submission])
+                print_result(info, results[submission])
+
+                if (upload):
+                    await upload_queue.put(results[submission])
+
+        async def grade_stage():
+            await asyncio.gather(*(grade_worker() for _ in range(jobs)))
+
+            for _ in range(UPLOAD_WORKERS):
+                await upload_queue.put(None)
+
+        async def upload_worker(uploader):
+            while True:
+                result = await upload_queue.get()
+                if (result is None):
+                    return
+
+                student = Student_Info(result.student_name, result.student_id, result.score, result.feedback_path(dir_to_grade), result.attempt_id)
+                await loop.run_in_executor(threads, uploader.upload, student)
+
+        if (upload):
+            with Grade_Uploader(assignment_id, dir_to_grade, store) as uploader:
+                await asyncio.gather(download_stage(), grade_stage(), *(upload_worker(uploader) for _ in range(UPLOAD_WORKERS)))
+        else:
+            await asyncio.gather(download_stage(), grade_stage())
 
-            run_result = run_cmd(info.run_step_command, [], timeout)
+    if (failed_downloads):
+        print(f"<!> {len(failed_downloads)} download(s) failed, run again to retry just those")
 
-            if not run_result[0] or not os.path.isfile(info.file_with_grade):
-                output_file.write(f"Your submission did not produce the expected result file when running the driver. Most likely a Segmentation Fault\nYour score: 0/{info.total_points}")
+    submissions = [s for s in index.files() if is_submission(info, dir_to_grade, s)]
 
-                if (os.path.isdir(os.path.join(os.getcwd(), "CMakeFiles/"))):
-                    rmtree(os.path.join(os.getcwd(), "CMakeFiles/"))
-                elif (os.path.isdir(os.path.join(os.getcwd(), "build/"))):
-                    rmtree(os.path.join(os.getcwd(), "build/"))
+    # results are handed back in the same order a sequential run would have graded them in
+    return (len(submissions), [results[s] for s in sorted(results)])
 
-                os.chdir(dir_to_grade)
-                print("[0/100] <!> Crashed or Encounted an Error\n")
-                result_csv.write(f"{student_name},{student_id},{score},{dir_to_grade}{sub_file}/{student_name}.results.txt\n")
-                continue
-            
-            score = grab_score(info.file_with_grade)
+# gets the paths of all of a submission's other files, see get_attachments_dir
+def get_attachment_files(dir_to_grade, submission):
+    attachments_dir = os.path.join(dir_to_grade, get_attachments_dir(submission))
+    if (not os.path.isdir(attachments_dir)):
+        return []
+    return [os.path.join(attachments_dir, f) for f in list_files(attachments_dir)]
 
-            if (score > info.total_points):
-                score = info.total_points
-            
-            if (score == info.total_points):
-                output_file.write(f"All output matched expected!\nYour score: {score}/{info.total_points}\nCongrats, full points!")
-            else:
-                output_file.write(f"Your score: {score}/{info.total_points}")
-            
-            output_file.write("\n\nDriver Output:\n")
-            
-            with open(info.file_with_grade) as result_file:
-                for line in result_file.readlines():
-                    output_file.write(line)
+# gets where a submission's other files end up inside of its workspace, relative to the workspace
+def get_workspace_attachments(dir_to_grade, submission):
+    return [os.path.relpath(f, os.path.join(dir_to_grade, get_attachments_dir(submission))) for f in get_attachment_files(dir_to_grade, submission)]
 
-            print(f"[{score}/{info.total_points}]\n")
+"""
+gets every file that can change a submission's grade: the submission itself, the reference exe or solution, 
+any required files and the submission's test input
+"""
+def get_result_files(info, dir_to_grade, submission, test_bank):
+    files = [os.path.join(dir_to_grade, submission)] + get_attachment_files(dir_to_grade, submission)
 
-            result_csv.write(f"{student_name},{student_id},{score},{dir_to_grade}{sub_file}/{student_name}.results.txt\n")
-            scores_for_avg += score
-            output_file.close()
-            
-            if (os.path.isdir(os.path.join(os.getcwd(), "CMakeFiles/"))):
-                rmtree(os.path.join(os.getcwd(), "CMakeFiles/"))
-            elif (os.path.isdir(os.path.join(os.getcwd(), "build/"))):
-                rmtree(os.path.join(os.getcwd(), "build/"))
+    if info.compiled and info.test_cases:
+        files += [os.path.join(dir_to_grade, info.reference_exe)] + test_bank
+    elif info.compiled:
+        files += [os.path.join(dir_to_grade, info.reference_exe), pick_test_input(test_bank, submission.split("_")[1])]
+    elif info.interpreted:
+        files += [os.path.join(dir_to_grade, f) for f in info.required_files + [info.reference_solution]]
+    elif info.external:
+        files += [os.path.join(dir_to_grade, f) for f in info.required_files]
+
+    return files
+
+"""
+grades a submission with the given grader, unless it has already been graded with the exact same submission, 
+grading info, reference and test input. then the score and feedback from last time are reused and nothing is run
+
+@params:
+    grader       - the function that grades this kind of submission
+    info         - the grading info object
+    dir_to_grade - the directory to grade and download submissions to
+    submission   - the submission filename
+    timeout      - the timeout for each run
+    use_cache    - whether or not cached results can be used
+    test_bank    - the generated test inputs
+    extra_args   - any other args for the grader
+"""
+def grade_submission(grader, info, dir_to_grade, submission, timeout, use_cache, test_bank, *extra_args):
+    start = time.perf_counter()
+    result = grade_submission_once(grader, info, dir_to_grade, submission, timeout, use_cache, test_bank, *extra_args)
+    result.duration = None if result.cached else round(time.perf_counter() - start, 3)
+    return result
+
+def grade_submission_once(grader, info, dir_to_grade, submission, timeout, use_cache, test_bank, *extra_args):
+    # every phase for this submission is tagged with it in the trace
+    with phase("grade", submission=submission):
+        cache_dir  = get_cache_dir(dir_to_grade, use_cache)
+        result_files = get_result_files(info, dir_to_grade, submission, test_bank)
+        result_key   = make_key(result_files, [grader.__name__, submission, vars(info), timeout, get_result_args(grader, extra_args), 
+                                               [os.path.relpath(f, dir_to_grade) for f in result_files]])
+
+        cached = load_cached_value(cache_dir, "results", result_key)
+
+        if (cached is not None):
+            result = Grade_Result(cached["student_name"], cached["student_id"], cached["sub_file"], cached["score"], cached["note"], cached.get("usage"))
+            result.cached = True
+            os.makedirs(os.path.join(dir_to_grade, result.sub_file), exist_ok=True)
+
+            with phase("feedback write", cached=True), open(result.feedback_path(dir_to_grade), "w") as output_file:
+                output_file.write(cached["feedback"])
+
+            return result
+
+        result = grader(info, dir_to_grade, submission, timeout, use_cache, *extra_args)
+        finish_workspace(dir_to_grade, result.sub_file, [f"{result.student_name}.results.txt"])
+
+        with open(result.feedback_path(dir_to_grade)) as output_file:
+            store_cached_value(cache_dir, "results", result_key, dict(vars(result), feedback=output_file.read()))
+
+        return result
+
+# gets the grader args that can change a result, how many test cases run at the same time never does
+def get_result_args(grader, extra_args):
+    return extra_args[:-1] if grader is grade_compiled_submission else extra_args
+
+# saves a result in the results store, along with a hash of its feedback
+def record_result(store, dir_to_grade, result):
+    feedback_path = result.feedback_path(dir_to_grade)
+    result.attempt_id = store.record_attempt(result, feedback_path, hash_file(feedback_path))
+
+# prints the score for a submission once it has been graded
+def print_result(info, result):
+    print(f"Grading {result.student_name}'s submission... [{result.score}/{info.total_points}] {result.note}".rstrip() + "\n")
+
+"""
+sets up a submission's own working directory, the submission is graded entirely inside of this directory. 
+it is in the dir to grade, or in RAM when staging on tmpfs (see staging.py)
+
+@params:
+    dir_to_grade - the directory to grade and download submissions to
+    submission   - the submission filename
+    shared_files - files from the dir to grade that the submission needs to be graded
+"""
+def make_workspace(dir_to_grade, submission, shared_files):
+    # submissions are in this format: 
+    #           <pid>_<canvas id>_<assignment id>_<submission name>.<file extension>
+    #           jamesw98_1234_4242_p2.hs
+    sub_split = submission.split("_")
+    sub_file  = submission.split(".")[0]
+    workspace = get_workspace(dir_to_grade, sub_file)
+
+    with phase("stage"):
+        # if there is not already a directory for this student, create one
+        if (not os.path.isdir(workspace)):
+            os.mkdir(workspace)
+
+        copy(os.path.join(dir_to_grade, submission), workspace)
+
+        # the rest of a multi-file submission is put in next to it
+        if (os.path.isdir(os.path.join(dir_to_grade, get_attachments_dir(submission)))):
+            copytree(os.path.join(dir_to_grade, get_attachments_dir(submission)), workspace, dirs_exist_ok=True)
+
+        for f in shared_files:
+            stage_shared_file(os.path.join(dir_to_grade, f), workspace)
+
+    return (sub_split[0], sub_split[1], sub_file, workspace)
+
+# removes any build directories left over from an external build
+def remove_build_dirs(workspace):
+    if (os.path.isdir(os.path.join(workspace, "CMakeFiles/"))):
+        rmtree(os.path.join(workspace, "CMakeFiles/"))
+    elif (os.path.isdir(os.path.join(workspace, "build/"))):
+        rmtree(os.path.join(workspace, "build/"))
+
+# shared build trees for external grading are kept in this directory inside of the dir to grade
+SHARED_BUILD_DIR = ".shared_builds"
+
+# the build tree this process has already configured, and the other files the last student put in it
+_shared_build_tree = None
+_shared_build_extras = []
 
-            os.chdir(dir_to_grade)
+"""
+gets this worker's build tree for external grading. the first time a worker asks for it, the required files
+and the student's file are copied in and the build step (e.g. the CMake configure) is run. after that every
+student's file is just copied over the last one, so only it gets recompiled. CMake trees can't be cloned to another path, they remember
+where they were configured, so each worker keeps its own tree instead. the student's other files (see
+get_attachments_dir) are copied in too, after the last student's are taken out, the required files always
+win over them like they do in a workspace
+
+@params:
+    info         - the grading info object
+    dir_to_grade - the directory to grade and download submissions to
+    student_file - the student's file to build
+    extra_files  - the student's other files, relative to the directory student_file is in
+    timeout      - the timeout for the build step
+"""
+def get_shared_build_tree(info, dir_to_grade, student_file, extra_files, timeout):
+    global _shared_build_tree, _shared_build_extras
+    build_dir = os.path.join(dir_to_grade, SHARED_BUILD_DIR, str(os.getpid()))
+
+    if (_shared_build_tree == build_dir):
+        for f in _shared_build_extras:
+            if (os.path.lexists(os.path.join(build_dir, f))):
+                os.remove(os.path.join(build_dir, f))
+    else:
+        if (os.path.isdir(build_dir)):
+            rmtree(build_dir)
+        os.makedirs(build_dir)
+
+    for f in extra_files:
+        os.makedirs(os.path.dirname(os.path.join(build_dir, f)), exist_ok=True)
+        copy(os.path.join(os.path.dirname(student_file), f), os.path.join(build_dir, f))
+    _shared_build_extras = extra_files
+
+    if (_shared_build_tree != build_dir):
+        for f in info.required_files:
+            copy(os.path.join(dir_to_grade, f), build_dir)
+        copy(student_file, os.path.join(build_dir, info.student_filename))
+
+        with phase("build"):
+            run_cmd(info.build_step_command, [], timeout, build_dir)
+        _shared_build_tree = build_dir
+    else:
+        # puts back any required files the last student's program (or files) changed
+        for f in info.required_files:
+            if (not os.path.isfile(os.path.join(build_dir, f)) or hash_file(os.path.join(build_dir, f)) != hash_file(os.path.join(dir_to_grade, f))):
+                copy(os.path.join(dir_to_grade, f), build_dir)
+
+        copy(student_file, os.path.join(build_dir, info.student_filename))
 
-    return (total_submissions, graded_submissions, scores_for_avg)
+    # a result file from the last student should never be mistaken for this one's
+    if (os.path.isfile(os.path.join(build_dir, info.file_with_grade))):
+        os.remove(os.path.join(build_dir, info.file_with_grade))
+
+    return build_dir
 
 """
-Grades interpreted submissions
+Grades a single submission for an external assignment
 
 @params:
     info         - the grading info object
     dir_to_grade - the directory to grade and download submissions to
-    dont_grade   - submissions to skip over, usually unchanged submissions
-    result_csv   - the csv file to write results to
+    submission   - the submission filename
+    timeout      - the timeout for each step
+    use_cache    - whether or not cached results can be used
 """
-def grade_interpreted(info, dir_to_grade, dont_grade, result_csv, timeout):
-    total_submissions = graded_submissions = scores_for_avg = 0
+def grade_external_submission(info, dir_to_grade, submission, timeout, use_cache):
+    student_name, student_id, sub_file, workspace = make_workspace(dir_to_grade, submission, [] if info.shared_build else info.required_files)
+    limits = Run_Limits(info.limits, info.max_output_bytes)
+    usage  = Run_Usage()
+
+    # creates an output result file for this submission 
+    output_file = open(os.path.join(workspace, f"{student_name}.results.txt"), "w")
+
+    if (info.shared_build):
+        # only the student's file changes in this worker's build tree, so only it gets rebuilt
+        build_dir = get_shared_build_tree(info, dir_to_grade, os.path.join(workspace, submission), 
+                                          get_workspace_attachments(dir_to_grade, submission), timeout)
+    else:
+        build_dir = workspace
+        os.rename(os.path.join(workspace, submission), os.path.join(workspace, info.student_filename))
 
-    for submission in os.listdir(os.getcwd()):
-        score = 0
+        with phase("build"):
+            run_cmd(info.build_step_command, [], timeout, build_dir)
 
-        # makes sure to only run student submissions and submission that should be graded
-        if (".txt" not in submission and ".csv" not in submission and submission 
-           not in info.required_files and submission != info.reference_solution and 
-           not os.path.isdir(os.path.join(os.getcwd(), submission))):
+    with phase("compile"):
+        compile_result = run_cmd(info.compile_step_command, [], timeout, build_dir)
 
-            total_submissions += 1
+    if not compile_result[0]:
+        output_file.write(f"Your submission did not compile. See compiler output below\nYour score: 0/{info.total_points}\n\nCompiler Output:\n")
+        output_file.write(compile_result[1])
+        output_file.close()
 
-            # if the submission shouldn't be graded, don't grade it
-            if submission in dont_grade:
-                continue
-                
-            graded_submissions += 1
-
-            # submissions are in this format: 
-            #           <pid>_<canvas id>_<assignment id>_<submission name>.<file extension>
-            #           jamesw98_1234_4242_p2.hs
-            sub_split = submission.split("_")
-            sub_file = submission.split(".")[0]
-            student_id = sub_split[1]
-            student_name = sub_split[0]
-
-            # if there is not already a directory for this student, create one
-            if (not os.path.isdir(sub_file)):
-                os.mkdir(sub_file)
-            
-            copy(submission, f"{sub_file}/")
-
-            for f in info.required_files:
-                copy(f, f"{sub_file}/")
-            copy(info.reference_solution, f"{sub_file}/")
-
-            os.chdir(f"{sub_file}/")
-
-            print(f"Grading {student_name}'s submission...", end=" ")
-
-            # creates an output result file for this submission 
-            output_file = open(f"{student_name}.results.txt", "w")
-            output_file.write(f"Running tests for {sub_file}...\n\n")
-
-            score = run_test_interpreted(submission, 
-                                        info.points_per_line, 
-                                        info.reference_solution, 
-                                        info.main_file, 
-                                        info.common_file, 
-                                        output_file,
-                                        timeout, info)
-                
-            # write score, special message for people that got a 100 :)
-            if (score == info.total_points):
-                output_file.write(f"All output matched expected!\nYour score: {score}/{info.total_points}\nCongrats, full points!")
-            else:
-                output_file.write(f"Your score: {score}/{info.total_points}")
+        if (not info.shared_build):
+            remove_build_dirs(build_dir)
+        return Grade_Result(student_name, student_id, sub_file, 0, "<!> Didn't compile", usage=usage.summary())
+
+    with phase("student run"):
+        run_result = run_cmd(info.run_step_command, [], timeout, build_dir, None, limits, usage)
+    grade_file = os.path.join(build_dir, info.file_with_grade)
 
-            os.chdir(dir_to_grade)
+    if not run_result[0] or not os.path.isfile(grade_file):
+        output_file.write(f"Your submission did not produce the expected result file when running the driver. Most likely a Segmentation Fault\nYour score: 0/{info.total_points}")
+        output_file.close()
 
-            print(f"[{score}/{info.total_points}]\n")
+        if (not info.shared_build):
+            remove_build_dirs(build_dir)
+        return Grade_Result(student_name, student_id, sub_file, 0, "<!> Crashed or Encounted an Error", usage=usage.summary())
+    
+    score = grab_score(grade_file)
 
-            result_csv.write(f"{student_name},{student_id},{score},{dir_to_grade}{sub_file}/{student_name}.results.txt\n")
-            scores_for_avg += score
-            output_file.close()
+    if (score > info.total_points):
+        score = info.total_points
     
-    return (total_submissions, graded_submissions, scores_for_avg)
+    with phase("feedback write"):
+        if (score == info.total_points):
+            output_file.write(f"All output matched expected!\nYour score: {score}/{info.total_points}\nCongrats, full points!")
+        else:
+            output_file.write(f"Your score: {score}/{info.total_points}")
+        
+        output_file.write("\n\nDriver Output:\n")
+        
+        with open(grade_file) as result_file:
+            for line in result_file.readlines():
+                output_file.write(line)
+
+        output_file.close()
+
+    if (info.shared_build):
+        # so the next student in this build tree can't be graded with this student's result file
+        os.remove(grade_file)
+    else:
+        remove_build_dirs(build_dir)
+
+    return Grade_Result(student_name, student_id, sub_file, score, usage=usage.summary())
+
+"""
+Grades a single interpreted submission
+
+@params:
+    info         - the grading info object
+    dir_to_grade - the directory to grade and download submissions to
+    submission   - the submission filename
+    timeout      - the timeout for each run
+    use_cache    - whether or not cached reference outputs can be used
+"""
+def grade_interpreted_submission(info, dir_to_grade, submission, timeout, use_cache):
+    student_name, student_id, sub_file, workspace = make_workspace(dir_to_grade, submission, info.required_files + [info.reference_solution])
+    limits = Run_Limits(info.limits, info.max_output_bytes)
+    usage  = Run_Usage()
+
+    # creates an output result file for this submission 
+    output_file = open(os.path.join(workspace, f"{student_name}.results.txt"), "w")
+    output_file.write(f"Running tests for {sub_file}...\n\n")
+
+    score = run_test_interpreted(submission, 
+                                 info.points_per_line, 
+                                 info.reference_solution, 
+                                 info.main_file, 
+                                 info.common_file, 
+                                 output_file,
+                                 timeout, info,
+                                 workspace,
+                                 get_cache_dir(dir_to_grade, use_cache),
+                                 limits, usage)
+        
+    # write score, special message for people that got a 100 :)
+    with phase("feedback write"):
+        if (score == info.total_points):
+            output_file.write(f"All output matched expected!\nYour score: {score}/{info.total_points}\nCongrats, full points!")
+        else:
+            output_file.write(f"Your score: {score}/{info.total_points}")
+
+        output_file.close()
+
+    return Grade_Result(student_name, student_id, sub_file, score, usage=usage.summary())
 
 """
-Grades compiled submissions
+Grades a single compiled submission
 
 @params:
     info          - the grading info object
     dir_to_grade  - the directory to grade and download submissions to
-    dont_grade    - submissions to skip over, usually unchanged submissions
-    orig_dir      - the original directory
+    submission    - the submission filename
+    timeout       - the timeout for each run
+    use_cache     - whether or not cached reference outputs can be used
+    test_bank     - the generated test inputs
     json_file     - the json file object
     json_filename - the filename for the json file
-    result_csv    - the csv file to write results to
+    case_jobs     - how many test cases to run at the same time, see run_test_cases
 """
-def grade_compiled(info, dir_to_grade, dont_grade, orig_dir, json_file, json_filename, result_csv, timeout):
-    total_submissions = graded_submissions = scores_for_avg = 0
+def grade_compiled_submission(info, dir_to_grade, submission, timeout, use_cache, test_bank, json_file, json_filename, case_jobs=1):
+    student_name, student_id, sub_file, workspace = make_workspace(dir_to_grade, submission, [info.reference_exe])
+    limits = Run_Limits(info.limits, info.max_output_bytes)
+    usage  = Run_Usage()
+
+    # grab this submission's input from the test bank, test cases get their inputs in their own directories
+    if (not info.test_cases):
+        stage_shared_file(pick_test_input(test_bank, student_id), workspace)
+
+    # creates an output result file for this submission 
+    output_file = open(os.path.join(workspace, f"{student_name}.results.txt"), "w")
+    output_file.write(f"Running tests for {sub_file}...\n\n")
+
+    student_compiled = compile(info.compiler, submission, workspace, info.compiler_flags, get_cache_dir(dir_to_grade, use_cache),
+                               get_attachment_files(dir_to_grade, submission))
+
+    # compile, and make sure it actually compiled successfully  
+    if (not student_compiled[0]):
+        # Sad! submission didn't compile, award no points
+        output_file.write(f"""Your submission did not compile. See compiler output below\n
+                          Your score: 0/{info.total_points}\n\n
+                          Compiler Output:\n""")
+        output_file.write(student_compiled[1])
+        output_file.close()
+
+        return Grade_Result(student_name, student_id, sub_file, 0, "<!> Didn't compile", usage=usage.summary())
+
+    if (info.test_cases):
+        score = run_test_cases(info, submission, workspace, test_bank, get_workspace_attachments(dir_to_grade, submission), output_file, timeout, json_file, json_filename,
+                               get_cache_dir(dir_to_grade, use_cache), limits, usage, case_jobs)
+    # if the project being graded takes input from stdin, as is the case for 3304 p1 (sentence diagramming)
+    elif (info.stdout):
+        score = run_tests_stdout(info.generator_output, 
+                                 f"./{compiled_exe_name(info.compiler, submission)}", 
+                                 f"./{info.reference_exe}", 
+                                 info.points_per_line, 
+                                 output_file,
+                                 info.reference_exe_args,
+                                 info.student_exe_args,
+                                 timeout, 
+                                 workspace,
+                                 True,
+                                 get_cache_dir(dir_to_grade, use_cache),
+                                 info.record_delimiter if info.batch_stdin else None,
+                                 limits, usage)
+    else:
+        student_output = get_value_from_json("output_filename", json_file, json_filename)
 
-    for submission in os.listdir(os.getcwd()):
-        score = 0
+        if (not student_output):
+            print(f"Error: 'output_filename' not found in {json_filename}")
+            exit(1)
 
-        # makes sure to only run student submissions and submission that should be graded
-        if (submission != info.generator_output and submission not in info.reference_exe and 
-           ".txt" not in submission and ".csv" not in submission and
-           not os.path.isdir(os.path.join(os.getcwd(), submission))):
+        score = run_tests_output_files(info.generator_output, 
+                                       f"./{sub_file}", 
+                                       f"./{info.reference_exe}", 
+                                       info.points_per_line, 
+                                       info.reference_exe_output, 
+                                       student_output, 
+                                       output_file,
+                                       info.reference_exe_args,
+                                       info.student_exe_args,
+                                       info.compiler,
+                                       timeout,
+                                       workspace,
+                                       get_cache_dir(dir_to_grade, use_cache),
+                                       limits, usage)
+
+    # write score, special message for people that got a 100 :)
+    with phase("feedback write"):
+        if (score == info.total_points):
+            output_file.write(f"All output matched expected!\nYour score: {score}/{info.total_points}\nCongrats, full points!")
+        else:
+            output_file.write(f"Your score: {score}/{info.total_points}")
 
-            total_submissions += 1
+        output_file.close()
 
-            # if the submission shouldn't be graded, don't grade it
-            if submission in dont_grade:
-                continue
-                
-            graded_submissions += 1
+    return Grade_Result(student_name, student_id, sub_file, score, usage=usage.summary())
 
-            # go and create a randomized input file for each submission
-            os.chdir(orig_dir)
+# each test case is run in its own directory in the workspace, so cases that write the same files can run at the same time
+CASES_DIR = ".cases"
 
-            print(f"Running {info.generator}...", end=" ")
-            poke_generator(json_file, info.generator)
-            if (info.generator_output not in os.listdir(dir_to_grade)):
-                copy(info.generator_output, os.path.join(dir_to_grade, info.generator_output))
-            
-            os.chdir(dir_to_grade)
-            
-            # give some info about the generator output
-            print(f"{len(open(dir_to_grade + info.generator_output).readlines())} lines generated")
-
-            # submissions are in this format: 
-            #           <pid>_<canvas id>_<assignment id>_<submission name>.<file extension>
-            #           jamesw98_1234_4242_p2.hs
-            sub_split = submission.split("_")
-            sub_file = submission.split(".")[0]
-            student_id = sub_split[1]
-            student_name = sub_split[0]
-
-            # if there is not already a directory for this student, create one
-            if (not os.path.isdir(sub_file)):
-                os.mkdir(sub_file)
-            
-            copy(submission, f"{sub_file}/")
+"""
+runs every test case for a compiled submission, case_jobs at a time (see --case-jobs).
+each case is run in its own directory with the student's executable, the reference, the submission's other
+files and the case's input, and gets its own section of the feedback. the sections are written in the same
+order as the test cases no matter which case finishes first. the smoke tier (see get_test_cases) is run
+before the rest, and the rest are only run if it passes. returns the submission's total score
 
-            copy(info.generator_output, f"{sub_file}/")
+@params:
+    info          - the grading info object
+    submission    - the submission filename
+    workspace     - the submission's working directory, the student's program is already compiled in here
+    case_inputs   - the input for each test case, see build_case_inputs
+    extra_files   - the submission's other files, relative to the workspace
+    output_file   - the output file for this submission
+    timeout       - the timeout for each run, unless the case has its own
+    json_file     - the json file object
+    json_filename - the filename for the json file
+    cache_dir     - where reference outputs are cached, None to always run the reference
+    limits        - the Run_Limits for the student's program
+    usage         - the Run_Usage to add every case's runs to
+    case_jobs     - how many test cases to run at the same time
+"""
+def run_test_cases(info, submission, workspace, case_inputs, extra_files, output_file, timeout, json_file, json_filename, cache_dir, limits, usage, case_jobs=1):
+    student_output = None
 
-            copy(info.reference_exe, f"{sub_file}/")
+    if (not info.stdout):
+        student_output = get_value_from_json("output_filename", json_file, json_filename)
 
-            os.chdir(f"{sub_file}/")
+        if (not student_output):
+            print(f"Error: 'output_filename' not found in {json_filename}")
+            exit(1)
 
-            print(f"Grading {student_name}'s submission...", end=" ")
+    cases = list(zip(info.test_cases, case_inputs))
+    case_jobs = min(len(cases), case_jobs)
+    case_results = {}
+
+    # the phases of every case are tagged with the submission, each case needs its own copy of the context for that
+    def run_tier(pool, tier):
+        futures = {case["name"]: pool.submit(contextvars.copy_context().run, run_test_case, info, submission, workspace, case, case_input,
+                                             extra_files, timeout, student_output, cache_dir, limits) for case, case_input in tier}
+        case_results.update((name, future.result()) for name, future in futures.items())
+
+    with ThreadPoolExecutor(max_workers=case_jobs) as pool:
+        # the smoke tier is run first, a program that already crashes or times out on it isn't run on anything bigger
+        run_tier(pool, [c for c in cases if c[0]["smoke"]])
+        failed = [(case["name"], case_results[case["name"]][2].exit_reason) for case, _ in cases 
+                  if case["smoke"] and case_results[case["name"]][2].exit_reason != "ok"]
+
+        if (failed):
+            for case, _ in cases:
+                if (not case["smoke"]):
+                    case_results[case["name"]] = (0, f"Not run, your program failed the smoke test {failed[0][0]} ({failed[0][1]}). Fix that first!\n", Run_Usage())
+        else:
+            run_tier(pool, [c for c in cases if not c[0]["smoke"]])
 
-            # creates an output result file for this submission 
-            output_file = open(f"{student_name}.results.txt", "w")
-            output_file.write(f"Running tests for {sub_file}...\n\n")
+    score = 0
 
-            student_compiled = True
-            if (info.compiled):
-                student_compiled = compile(info.compiler, submission)
+    for case, _ in cases:
+        case_score, feedback, case_usage = case_results[case["name"]]
 
-            # compile, and make sure it actually compiled successfully  
-            if (info.compiled and not student_compiled[0]):
-                # Sad! submission didn't compile, award no points
-                output_file.write(f"""Your submission did not compile. See compiler output below\n
-                                  Your score: 0/{info.total_points}\n\n
-                                  Compiler Output:\n""")
-                output_file.write(student_compiled[1])
-                output_file.close()
+        output_file.write(f"Test case {case['name']}:\n")
+        output_file.write(feedback)
+        output_file.write(f"Score for {case['name']}: {format_points(case_score)}/{format_points(case['weight'])}\n\n")
 
-                os.chdir(dir_to_grade)
-                print("[0/100] <!> Didn't compile\n")
-                result_csv.write(f"{student_name},{student_id},{score},{dir_to_grade}{sub_file}/{student_name}.results.txt\n")
-                continue
-        
-            # if the project being graded takes input from stdin, as is the case for 3304 p1 (sentence diagramming)
-            if (info.stdout):
-                score = run_tests_stdout(info.generator_output, 
-                                            f"./{sub_file}", 
-                                            f"./{info.reference_exe}", 
-                                            info.points_per_line, 
-                                            output_file,
-                                            info.reference_exe_args,
-                                            info.student_exe_args,
-                                            timeout, 
-                                            True)
-            else:
-                student_output = get_value_from_json("output_filename", json_file, json_filename)
-
-                if (not student_output):
-                    print(f"Error: 'output_filename' not found in {json_filename}")
-                    exit(1)
-
-                score = run_tests_output_files(info.generator_output, 
-                                                f"./{sub_file}", 
-                                                f"./{info.reference_exe}", 
-                                                info.points_per_line, 
-                                                info.reference_exe_output, 
-                                                student_output, 
-                                                output_file,
-                                                info.reference_exe_args,
-                                                info.student_exe_args,
-                                                info.compiler,
-                                                timeout)
-
-            # write score, special message for people that got a 100 :)
-            if (score == info.total_points):
-                output_file.write(f"All output matched expected!\nYour score: {score}/{info.total_points}\nCongrats, full points!")
-            else:
-                output_file.write(f"Your score: {score}/{info.total_points}")
+        usage.merge(case_usage)
+        score += case_score
 
-            os.chdir(dir_to_grade)
+    return round_points(score)
+
+"""
+runs one test case in its own directory, returns its score out of its weight, its feedback and its Run_Usage. 
+the case's points are split evenly across the lines that are compared, see below
+
+@params:
+    info           - the grading info object
+    submission     - the submission filename
+    workspace      - the submission's working directory
+    case           - the test case, see get_test_cases
+    case_input     - the case's input
+    extra_files    - the submission's other files, relative to the workspace
+    timeout        - the timeout for each run, unless the case has its own
+    student_output - the file the student's program writes, None if it writes to stdout
+    cache_dir      - where reference outputs are cached, None to always run the reference
+    limits         - the Run_Limits for the student's program
+"""
+def run_test_case(info, submission, workspace, case, case_input, extra_files, timeout, student_output, cache_dir, limits):
+    case_dir = os.path.join(workspace, CASES_DIR, case["name"])
+    feedback = io.StringIO()
+    usage    = Run_Usage()
+
+    with phase("test case", case=case["name"]):
+        with phase("stage"):
+            # anything left over from the last time this case was run here would be graded again
+            rmtree(case_dir, ignore_errors=True)
+            os.makedirs(case_dir)
+
+            # the executables are only ever run so every case can share them, the submission's other files are
+            # copied since a student's program could change them
+            for f in [compiled_exe_name(info.compiler, submission), info.reference_exe]:
+                os.link(os.path.join(workspace, f), os.path.join(case_dir, f))
+
+            for f in [submission] + extra_files:
+                os.makedirs(os.path.dirname(os.path.join(case_dir, f)), exist_ok=True)
+                copy(os.path.join(workspace, f), os.path.join(case_dir, f))
+
+            stage_shared_file(case_input, case_dir)
+
+        ref_args    = info.reference_exe_args + case["args"]
+        stu_args    = info.student_exe_args + case["args"]
+        timeout     = case["timeout"] or timeout
+
+        # every line of input gets one line of output on stdout, with an output file the reference's output lines
+        # are what is compared, so the weight is split across those once the reference has run
+        if (info.stdout):
+            input_lines = sum(1 for _ in read_lines(case_input))
+            score = run_tests_stdout(info.generator_output, f"./{compiled_exe_name(info.compiler, submission)}", f"./{info.reference_exe}",
+                                     case["weight"] / input_lines if input_lines else 0, feedback, ref_args, stu_args, timeout, case_dir, True, cache_dir,
+                                     info.record_delimiter if info.batch_stdin else None, limits, usage)
+        else:
+            score = run_tests_output_files(info.generator_output, f"./{submission.split('.')[0]}", f"./{info.reference_exe}", 0,
+                                           info.reference_exe_output, student_output, feedback, ref_args, stu_args, info.compiler,
+                                           timeout, case_dir, cache_dir, limits, usage, case["weight"])
 
-            print(f"[{score}/{info.total_points}]\n")
+    return (round_points(min(score, case["weight"])), feedback.getvalue(), usage)
 
-            result_csv.write(f"{student_name},{student_id},{score},{dir_to_grade}{sub_file}/{student_name}.results.txt\n")
-            scores_for_avg += score
-            output_file.close()
+# rounds points to 2 decimal places, whole points are kept as ints so they never show up with a .0
+def round_points(points):
+    points = round(points, 2)
+    return int(points) if float(points).is_integer() else points
 
-    return (total_submissions, graded_submissions, scores_for_avg)
+def format_points(points):
+    return str(round_points(points))
 
 """
 Runs tests for interpreted submissions
@@ -478,35 +1086,66 @@ Runs tests for interpreted submissions
     main_file          - the main file to be run
     common_file        - the file/class that is represented by both the student's submission and the reference solution
     output_file        - the output file for this submission
+    cwd                - the submission's working directory
+    cache_dir          - where reference outputs are cached, None to always run the reference
+    limits             - the Run_Limits for the student's program
+    usage              - the Run_Usage to record the student's run in
 """
-def run_test_interpreted(student_file, points, reference_solution, main_file, common_file, output_file, timeout, info):
+def run_test_interpreted(student_file, points, reference_solution, main_file, common_file, output_file, timeout, info, cwd, cache_dir=None, limits=None, usage=None):
     score = 0
 
+    student_file       = os.path.join(cwd, student_file)
+    reference_solution = os.path.join(cwd, reference_solution)
+    common_file        = os.path.join(cwd, common_file)
+
+    student_output   = os.path.join(cwd, ".student_output")
+    reference_output = os.path.join(cwd, ".reference_output")
+
     os.rename(student_file, common_file)
-    student_run = run_cmd(f"./{main_file}", info.student_exe_args, timeout)
+    with phase("student run"), open(student_output, "wb") as f:
+        student_run = run_cmd_to_file(f"./{main_file}", info.student_exe_args, timeout, f, cwd, None, limits, usage)
 
     if (not student_run[0]):
         output_file.write(f"An exception occurred while running your program:\n{student_run[1]}\n")
         return 0
 
-    student_output = student_run[1].split("\n")
     os.rename(common_file, student_file)
-    os.rename(reference_solution, common_file)
-
-    # shouldn't need to check that the reference solution encounters an exception
-    reference_output = run_cmd(f"./{main_file}", info.reference_exe_args, timeout)[1].split("\n")
-
-    for i in range(len(reference_output) - 1):
-        if (i >= len(student_output)):
-            output_file.write(f"Your code did not produce enough lines! -{points} points")
-            output_file.write(f"Expected: {reference_output[i]}\n")
-            output_file.write(f"Received: <empty line>\n\n")
-        elif (student_output[i].lower() == reference_output[i].lower()):
-            score += points
-        else:
-            output_file.write(f"Output did not match expected! -{points} points\n")
-            output_file.write(f"Expected: {reference_output[i]}\n")
-            output_file.write(f"Received: {student_output[i]}\n\n")
+
+    # the reference output only depends on the reference solution, the files it is run with and its args
+    ref_key = make_key([reference_solution] + [os.path.join(cwd, f) for f in info.required_files], [main_file, info.reference_exe_args])
+
+    if (not load_cached_file(cache_dir, "reference", ref_key, reference_output)):
+        os.rename(reference_solution, common_file)
+
+        # shouldn't need to check that the reference solution encounters an exception
+        with phase("reference run"), open(reference_output, "wb") as f:
+            reference_run = run_cmd_to_file(f"./{main_file}", info.reference_exe_args, timeout, f, cwd)
+
+        if (reference_run[0]):
+            store_cached_file(cache_dir, "reference", ref_key, reference_output)
+
+    # both outputs are read a line at a time, so a huge output never ends up in memory
+    with phase("comparison"):
+        for reference_line, student_line in zip_longest(read_lines(reference_output), read_lines(student_output)):
+            if (reference_line is None):
+                break
+
+            reference_line = reference_line.rstrip("\n")
+
+            if (student_line is None):
+                output_file.write(f"Your code did not produce enough lines! -{format_points(points)} points")
+                output_file.write(f"Expected: {reference_line}\n")
+                output_file.write(f"Received: <empty line>\n\n")
+                continue
+
+            student_line = student_line.rstrip("\n")
+
+            if (student_line.lower() == reference_line.lower()):
+                score += points
+            else:
+                output_file.write(f"Output did not match expected! -{format_points(points)} points\n")
+                output_file.write(f"Expected: {reference_line}\n")
+                output_file.write(f"Received: {student_line}\n\n")
 
     return score
 
@@ -519,43 +1158,96 @@ Runs tests that write to standard output
     ref_exe     - the reference/solution executable name
     points      - the points off per wrong line
     output_file - the output file
+    cwd         - the submission's working directory
     stdin       - whether or not the student submission expects input from stdin
+    cache_dir   - where reference outputs are cached, None to always run the reference
+    delimiter   - if set, all the input is sent to one process and its output is split on this, 
+                  otherwise a new process is started for every line
+    limits      - the Run_Limits for the student's program
+    usage       - the Run_Usage to record the student's runs in
 """
-def run_tests_stdout(input_file, student_exe, ref_exe, points, output_file, ref_args, stu_args, timeout, stdin=False):
+def run_tests_stdout(input_file, student_exe, ref_exe, points, output_file, ref_args, stu_args, timeout, cwd, stdin=False, cache_dir=None, delimiter=None, limits=None, usage=None):
     score = 0
 
     # reads all the lines from the input file
-    for line in open(input_file, "r").readlines():
-        # runs the reference and student solutions and gets there outputs
-        if (stdin):
-            correct_output = get_exe_output_stdin(ref_exe, ref_args, line, timeout)[1]
-            student_output = get_exe_output_stdin(student_exe, stu_args, line, timeout)
-
-        if (not student_output[0]):
-            output_file.write(f"Your code produced an error! -{points} points\n")
-            output_file.write(f"Input: {line}")
-            output_file.write(f"Expected: {correct_output}")
-            output_file.write(f"Error:\n{student_output[1]}")
-            continue
-
-        # if the output matches, award a point
-        # TODO manage spaces
-        # TODO managing blank lines (ignore them?)
-        combine_whitespace = re.compile(r"\s+")
-        correct_output = combine_whitespace.sub(" ", correct_output)
-        student_output = combine_whitespace.sub(" ", student_output)
-
-        if (correct_output.replace("\n", "").lower() == student_output[1].replace("\n", "").lower()):  
-            score += points
-        # if the output does not match, report the error including input, expected output, and received output 
+    input_file  = os.path.join(cwd, input_file)
+    input_lines = open(input_file, "r").readlines()
+
+    # runs the reference and student solutions and gets there outputs, either with one process for 
+    # all of the input split up on the record delimiter, or with a new process for every line
+    if (stdin):
+        correct_outputs = get_reference_outputs_stdin(input_file, input_lines, ref_exe, ref_args, timeout, cwd, cache_dir, delimiter)
+
+        if (delimiter is not None):
+            with phase("student run"):
+                student_outputs = get_exe_outputs_batched(student_exe, stu_args, input_lines, delimiter, timeout, cwd, limits, usage)
         else:
-            output_file.write(f"Output did not match expected! -{points} points\n")
-            output_file.write(f"Input: {line}") 
-            output_file.write(f"Expected: {correct_output}")
-            output_file.write(f"Received: {student_output[1]}\n")
+            # each line is only run once the comparison gets to it, so these runs show up inside of the comparison
+            def run_each_line():
+                for line in input_lines:
+                    with phase("student run"):
+                        student_output = get_exe_output_stdin(student_exe, stu_args, line, timeout, cwd, limits, usage)
+                    yield student_output
+
+            student_outputs = run_each_line()
+
+    with phase("comparison"):
+        for line, correct_output, student_output in zip(input_lines, correct_outputs, student_outputs):
+            if (not student_output[0]):
+                output_file.write(f"Your code produced an error! -{format_points(points)} points\n")
+                output_file.write(f"Input: {line}")
+                output_file.write(f"Expected: {correct_output}")
+                output_file.write(f"Error:\n{student_output[1]}")
+                continue
+
+            # if the output matches, award a point
+            # TODO manage spaces
+            # TODO managing blank lines (ignore them?)
+            combine_whitespace = re.compile(r"\s+")
+            correct_output = combine_whitespace.sub(" ", correct_output)
+            received       = combine_whitespace.sub(" ", student_output[1])
+
+            if (correct_output.replace("\n", "").lower() == received.replace("\n", "").lower()):  
+                score += points
+            # if the output does not match, report the error including input, expected output, and received output 
+            else:
+                output_file.write(f"Output did not match expected! -{format_points(points)} points\n")
+                output_file.write(f"Input: {line}") 
+                output_file.write(f"Expected: {correct_output}")
+                output_file.write(f"Received: {student_output[1]}\n")
 
     return score
 
+"""
+runs the reference exe on every line of an input file, the outputs are cached on the input file, 
+the reference exe and its args, so each input is only ever run through the reference once
+
+@params:
+    input_file  - the input file
+    input_lines - the lines of the input file
+    ref_exe     - the reference/solution executable name
+    ref_args    - the args for the reference exe
+    cwd         - the submission's working directory
+    cache_dir   - where reference outputs are cached, None to always run the reference
+    delimiter   - the record delimiter when running in batches, None for a process per line
+"""
+def get_reference_outputs_stdin(input_file, input_lines, ref_exe, ref_args, timeout, cwd, cache_dir, delimiter=None):
+    ref_key = make_key([input_file, os.path.join(cwd, ref_exe)], [ref_args, "stdin", delimiter])
+    correct_outputs = load_cached_value(cache_dir, "reference", ref_key)
+
+    if (correct_outputs is None):
+        with phase("reference run"):
+            if (delimiter is not None):
+                runs = get_exe_outputs_batched(ref_exe, ref_args, input_lines, delimiter, timeout, cwd)
+            else:
+                runs = [get_exe_output_stdin(ref_exe, ref_args, line, timeout, cwd) for line in input_lines]
+        correct_outputs = [run[1] for run in runs]
+
+        if (all(run[0] for run in runs)):
+            store_cached_value(cache_dir, "reference", ref_key, correct_outputs)
+
+    return correct_outputs
+
 """
 Runs tests that write to standard output
 
@@ -567,43 +1259,66 @@ Runs tests that write to standard output
     exp_ref_output - the output of the reference solution
     exp_stu_output - the output of the student's solution
     output_file    - the output file for this submission
+    cwd            - the submission's working directory
+    cache_dir      - where reference outputs are cached, None to always run the reference
+    limits         - the Run_Limits for the student's program
+    usage          - the Run_Usage to record the student's run in
+    weight         - when set, points is ignored and this many points are split evenly across the reference output's lines
 """
-def run_tests_output_files(input_file, student_exe, ref_exe, points, exp_ref_output, exp_stu_output, output_file, ref_args, stu_args, compiler, timeout):
+def run_tests_output_files(input_file, student_exe, ref_exe, points, exp_ref_output, exp_stu_output, output_file, ref_args, stu_args, compiler, timeout, cwd, cache_dir=None, limits=None, usage=None, weight=None):
     score = 0
 
-    # run reference solution on generated input
-    run_cmd(f"{ref_exe}", ref_args, timeout)
+    input_file     = os.path.join(cwd, input_file)
+    exp_ref_output = os.path.join(cwd, exp_ref_output)
+    exp_stu_output = os.path.join(cwd, exp_stu_output)
+
+    # run reference solution on generated input, unless it has already been run on the same input
+    ref_key = make_key([input_file, os.path.join(cwd, ref_exe)], [ref_args, os.path.basename(exp_ref_output)])
+
+    if (not load_cached_file(cache_dir, "reference", ref_key, exp_ref_output)):
+        with phase("reference run"):
+            run_cmd(f"{ref_exe}", ref_args, timeout, cwd)
+
+        if (os.path.exists(exp_ref_output)):
+            store_cached_file(cache_dir, "reference", ref_key, exp_ref_output)
+
     if (not os.path.exists(exp_ref_output)):
         print(f"Error: looking for {exp_ref_output}, but it was not found!")
         exit(0)
+
+    # only the reference output's lines are compared, so a weight is split across those and not the input's
+    if (weight is not None):
+        ref_lines = sum(1 for _ in read_lines(exp_ref_output))
+        points    = weight / ref_lines if ref_lines else 0
     
-    ref_lines = open(exp_ref_output, "r").readlines()
     # run student solution on generated input
-    
     if compiler == "gcc":
         student_exe = "./a.out"
 
-    student_output = run_cmd(student_exe, stu_args, timeout)
+    # only the output file is graded, so the student's stdout is thrown away (but still capped)
+    with phase("student run"), open(os.devnull, "wb") as devnull:
+        student_output = run_cmd_to_file(student_exe, stu_args, timeout, devnull, cwd, None, limits, usage)
+
     if (not student_output[0]):
         output_file.write(f"An exception occurred while running your program:\n{student_output[1]}\n")
         return 0
 
     if (path.isfile(exp_stu_output)):
-        student_lines = open(exp_stu_output, "r").readlines()
+        with phase("comparison"):
+            combine_whitespace = re.compile(r"\s+")
 
-        input_lines = open(input_file, "r").readlines()    
+            # the outputs are compared a line at a time, so they never have to fit in memory, lines past the end
+            # of the shorter output aren't compared
+            input_lines = chain(read_lines(input_file), repeat("\n"))
 
-        for i in range(len(ref_lines)):
-            if  (( i < len(ref_lines)) and (i < len(student_lines))):
-                combine_whitespace = re.compile(r"\s+")
-                
-                if combine_whitespace.sub(" ", ref_lines[i]) == combine_whitespace.sub(" ", student_lines[i]):
+            for ref_line, student_line, input_line in zip(read_lines(exp_ref_output), read_lines(exp_stu_output), input_lines):
+                if combine_whitespace.sub(" ", ref_line) == combine_whitespace.sub(" ", student_line):
                     score += points
                 else:
-                    output_file.write(f"Output did not match expected! -{points} point(s)\n")
-                    output_file.write(f"Input: {input_lines[i]}") # no \n needed, since line already contains one
-                    output_file.write(f"Expected: {ref_lines[i]}")
-                    output_file.write(f"Received: {student_lines[i]}\n")
+                    output_file.write(f"Output did not match expected! -{format_points(points)} point(s)\n")
+                    output_file.write(f"Input: {input_line}") # no \n needed, since line already contains one
+                    output_file.write(f"Expected: {ref_line}")
+                    output_file.write(f"Received: {student_line}\n")
     else:
         output_file.write("You did not create the expected output file. Please check the project specification")
     
@@ -625,6 +1340,11 @@ def check_compiled_required_files(info):
         print(f"Error: '{info.generator}' not found in the same dir as 'gradingtools.py'.")
         exit(1)
 
+    for case in info.test_cases:
+        if (case["input"] is not None and not os.path.isfile(case["input"])):
+            print(f"Error: '{case['input']}' (the input for test case {case['name']}) not found in the same dir as 'gradingtools.py'.")
+            exit(1)
+
 # ensures all the files required for an interpreted language are in cwd
 def check_interpreted_required_files(info):
     # ensures the required files in cwd
@@ -676,16 +1396,45 @@ def missing_json(info):
             not info.files_to_upload or not info.required_files
         )))
 
-# compiles a submission
-def compile(compiler, submission):
-    process = sp.run([compiler, submission], check=False, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE)
+# gets the name of the executable a compiler makes for a submission, gcc always names it a.out
+def compiled_exe_name(compiler, submission):
+    return "a.out" if compiler == "gcc" else submission.split(".")[0]
+
+"""
+compiles a submission. the executable and the compiler output are cached on the source, the compiler 
+and its flags, so a submission that hasn't changed is never compiled twice
+
+@params:
+    compiler   - the compiler to use
+    submission - the submission's filename
+    cwd        - the submission's working directory
+    flags      - extra flags for the compiler
+    cache_dir  - where compiles are cached, None to always compile
+"""
+def compile(compiler, submission, cwd=None, flags=[], cache_dir=None, extra_files=[]):
+    exe_name = os.path.join(cwd or ".", compiled_exe_name(compiler, submission))
+    # headers and anything else the submission came with can change what it compiles to
+    compile_key = make_key([os.path.join(cwd or ".", submission)] + extra_files, [compiler, flags, [os.path.basename(f) for f in extra_files]])
+
+    # the executable is always cached before the result, so a cached result always has its executable
+    cached = load_cached_value(cache_dir, "compile", f"{compile_key}.json")
+    if (cached is not None and (not cached[0] or load_cached_file(cache_dir, "compile", compile_key, exe_name))):
+        return tuple(cached)
+
+    with phase("compile"):
+        process = sp.run([compiler] + flags + [submission], check=False, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE, cwd=cwd)
 
     try:
         process.check_returncode()
-        return (True, process.stdout)
+        result = (True, process.stdout)
+        store_cached_file(cache_dir, "compile", compile_key, exe_name)
     except Exception as e:
-        error = process.stdout.replace("\n", "\n> ")
-        return (False, error)       
+        # most compilers write their errors to stderr
+        error = (process.stdout + process.stderr).replace("\n", "\n> ")
+        result = (False, error)
+
+    store_cached_value(cache_dir, "compile", f"{compile_key}.json", result)
+    return result
 
 # removes the CMakeFiles folder
 def remove_cmake_junk():
@@ -706,34 +1455,183 @@ def grab_score(filename):
 
     return score
 
-# runs a command through the subprocess library
-def run_cmd(exe, args, timeout):
-    exe = [exe]
+# how much of a program's stderr is kept for error messages, the rest is thrown away
+MAX_STDERR_BYTES = 64 * 1024
 
-    try:
-        exe = sp.run(exe + args, check=False, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE, timeout=timeout)
-    except sp.TimeoutExpired as e:
-        error = "Your program has timed out! Check for an infinite loop or contact your instructor"
-        return (False, error)
+# how much is read from a program's output at a time
+OUTPUT_CHUNK_SIZE = 64 * 1024
 
-    try:
-        exe.check_returncode()
-        return (True, exe.stdout)
-    except Exception as e:
-        error = "> " + exe.stderr.replace("\n", "\n> ")
-        return (False, error)
+# the longest line read at once when comparing outputs, longer lines are compared in pieces
+MAX_LINE_LENGTH = 64 * 1024
+
+"""
+runs a command with its stdout streamed straight into a file instead of into memory. once the program
+has printed its max output it is killed, so a program printing in an infinite loop can't take the grader
+down with it. the program runs in its own process group with the limits applied, and when it is done its
+cpu time, peak memory and exit reason are added to usage. returns (True, "") if the program ran
+successfully, (False, error message) if not
+
+@params:
+    exe     - the executable to run
+    args    - the args for the executable
+    timeout - the timeout for the run
+    output  - a file opened in binary mode to write the program's stdout to
+    cwd     - the working directory to run in
+    input_  - what to send to the program's stdin, None for no stdin
+    limits  - the Run_Limits for student programs, None for trusted programs (the reference, build steps)
+    usage   - the Run_Usage to record this run in, None to not record it
+"""
+def run_cmd_to_file(exe, args, timeout, output, cwd=None, input_=None, limits=None, usage=None):
+    max_bytes = limits.max_output_bytes if limits else DEFAULT_MAX_OUTPUT_BYTES
+    process = sp.Popen([exe] + args, stdin=sp.DEVNULL if input_ is None else sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, 
+                       cwd=cwd, start_new_session=True, preexec_fn=limits.apply if limits else None)
+    too_much_output = threading.Event()
+    reaped = threading.Event()
+    waited = {}
+    stderr = bytearray()
+
+    # kills the program and anything it started, the process group outlives the program itself
+    def kill():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    # wait4 is used instead of Popen.wait since it also gives back the resource usage for the run
+    def reap():
+        _, waited["status"], waited["rusage"] = os.wait4(process.pid, 0)
+        reaped.set()
+
+    def copy_stdout():
+        written = 0
+        for chunk in iter(lambda: process.stdout.read1(OUTPUT_CHUNK_SIZE), b""):
+            if (written + len(chunk) > max_bytes):
+                output.write(chunk[:max_bytes - written])
+                too_much_output.set()
+                kill()
+                return
+            output.write(chunk)
+            written += len(chunk)
+
+    # only the start of stderr is kept, but all of it is read so the program never blocks writing it
+    def copy_stderr():
+        for chunk in iter(lambda: process.stderr.read1(OUTPUT_CHUNK_SIZE), b""):
+            stderr.extend(chunk[:MAX_STDERR_BYTES - len(stderr)])
+
+    def feed_stdin():
+        try:
+            process.stdin.write(input_.encode())
+            process.stdin.close()
+        except (BrokenPipeError, OSError):
+            # the program exited without reading all of its input
+            pass
+
+    reaper  = threading.Thread(target=reap)
+    threads = [threading.Thread(target=copy_stdout), threading.Thread(target=copy_stderr)]
+    if (input_ is not None):
+        threads.append(threading.Thread(target=feed_stdin))
+
+    for t in [reaper] + threads:
+        t.start()
+
+    timed_out = not reaped.wait(timeout)
+    if (timed_out):
+        kill()
+        reaper.join()
+
+    # anything the program left running in the background would keep its output open forever
+    kill()
+    for t in threads:
+        t.join()
+    process.stdout.close()
+    process.stderr.close()
+
+    process.returncode = os.waitstatus_to_exitcode(waited["status"])
+    exit_reason = get_exit_reason(waited["status"], timed_out, too_much_output.is_set())
+
+    if (usage is not None):
+        usage.add(waited["rusage"], exit_reason)
+
+    if (timed_out):
+        return (False, "Your program has timed out! Check for an infinite loop or contact your instructor")
+    if (too_much_output.is_set()):
+        return (False, f"Your program printed more than {max_bytes} bytes of output! Check for an infinite loop or contact your instructor")
+    if (exit_reason in ["cpu limit", "file size limit"]):
+        return (False, f"Your program was stopped for going over its {exit_reason}! Check for an infinite loop or contact your instructor")
+    if (process.returncode != 0):
+        return (False, "> " + stderr.decode(errors="replace").replace("\n", "\n> "))
+
+    return (True, "")
+
+# runs a command through the subprocess library, its output is capped like run_cmd_to_file
+def run_cmd(exe, args, timeout, cwd=None, input_=None, limits=None, usage=None):
+    with tempfile.TemporaryFile() as output:
+        result = run_cmd_to_file(exe, args, timeout, output, cwd, input_, limits, usage)
+
+        if (not result[0]):
+            return result
+
+        output.seek(0)
+        return (True, read_output(output))
 
 # similar to run_cmd, but with stdin
-def get_exe_output_stdin(exe, args, input_, timeout):
-    exe = [exe]
-    exe = sp.run(exe + args, check=False, universal_newlines=True, stdout=sp.PIPE, stderr=sp.PIPE, input=input_, timeout=timeout)
+def get_exe_output_stdin(exe, args, input_, timeout, cwd=None, limits=None, usage=None):
+    return run_cmd(exe, args, timeout, cwd, input_, limits, usage)
 
-    try:
-        exe.check_returncode()
-        return (True, exe.stdout)
-    except Exception as e:
-        error = exe.stdout.replace("\n", "\n> ")
-        return (False, error)
+# decodes everything a program wrote to a binary output file, with the same newlines as text mode
+def read_output(output):
+    return io.TextIOWrapper(output, errors="replace").read()
+
+"""
+lazily reads the lines of a file, so comparing two outputs only ever needs a line of each in memory
+"""
+def read_lines(filename):
+    with open(filename, "r", errors="replace") as f:
+        for line in iter(lambda: f.readline(MAX_LINE_LENGTH), ""):
+            yield line
+
+"""
+runs one process for a whole input and splits its output back up into one result per input line,
+the program has to write the record delimiter after the output for each line
+
+@params:
+    exe         - the executable to run
+    args        - the args for the executable
+    input_lines - the lines of input, all of them are streamed to the same process
+    delimiter   - what the program writes after each record
+    timeout     - the timeout for the whole run
+    limits      - the Run_Limits for the program, None for the reference
+    usage       - the Run_Usage to record the run in
+"""
+def get_exe_outputs_batched(exe, args, input_lines, delimiter, timeout, cwd=None, limits=None, usage=None):
+    # whatever the program printed before it crashed or timed out is still in the file
+    with tempfile.TemporaryFile() as output_file:
+        ok, error = run_cmd_to_file(exe, args, timeout, output_file, cwd, "".join(input_lines), limits, usage)
+        output_file.seek(0)
+        output = read_output(output_file)
+
+    if (ok):
+        error = None
+
+    records = output.split(delimiter)
+
+    # the last record is followed by a delimiter too, so there is nothing after it
+    if (records[-1] == ""):
+        records.pop()
+
+    # any records the program never got to before it crashed or timed out count as errors, the delimiter is
+    # kept on the end of each record so they look the same as the output from a process per line
+    results = [(True, record + delimiter) for record in records[:len(input_lines)]]
+    while (len(results) < len(input_lines)):
+        results.append((False, error if error else "Your program did not produce any output for this input"))
+
+    return results
+
+# an argparse type for the counts that have to be at least 1
+def positive_int(value):
+    if (not value.isdigit() or int(value) < 1):
+        raise argparse.ArgumentTypeError(f"'{value}' has to be a whole number that is at least 1")
+    return int(value)
 
 # gets the arguments for the program
 def get_args():
@@ -743,6 +1641,12 @@ def get_args():
     parser.add_argument("-f", "--force-regrade", action="store_true", help="Forcefully regrade an entire directory/assignment")
     parser.add_argument("--debug", action="store_true", help="Run in debug mode, regrades all and does not upload grades")
     parser.add_argument("-l", "--local", action="store_true", help="Use this when you are only grading locally, no downloading/uploading submissions")
+    parser.add_argument("--no-cache", action="store_true", help="Don't use any cached reference outputs, compiles or results, everything is run from scratch")
+    parser.add_argument("--trace", type=str, help="Time every phase of the run and write the timings to this file as json lines")
+    parser.add_argument("--jobs", type=positive_int, default=1, help="The number of submissions to grade at the same time, each in its own worker process")
+    parser.add_argument("--staging", type=str, default="disk", choices=STAGING_BACKENDS, help="Where each submission is graded, tmpfs grades in RAM and only keeps the feedback")
+    parser.add_argument("--case-jobs", type=positive_int, help="The number of test cases of one submission to run at the same time, by default the cores left over from --jobs")
+    parser.add_argument("--pipeline", action="store_true", help="Grade each submission as soon as it is downloaded and upload it as soon as it is graded (ignored with --local)")
     args = parser.parse_args()
     
     return args
@@ -751,4 +1655,6 @@ def get_args():
 if (__name__ == "__main__"):
     args = get_args()
     print(args)
-    grade(args)
\ No newline at end of file
+
+    with staging(args.staging):
+        grade(args)
\ No newline at end of file
@@ -1,6 +1,11 @@
 #!/usr/bin/python3
 
-from random import choice
+from os import getenv
+from random import choice, seed
+
+# gradingtools passes a seed through GRADING_SEED when building a seeded test bank
+if getenv("GRADING_SEED") is not None:
+    seed(getenv("GRADING_SEED"))
 
 gman = """Time, Dr. Freeman? 
 Is it really that time again? 
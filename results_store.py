@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+# the results for an assignment live next to its submissions
+RESULTS_DB_FILENAME = "results.db"
+
+# how long a write waits on another connection's write before giving up, in milliseconds
+BUSY_TIMEOUT_MS = 30000
+
+# the states of each step (comment and grade) in the uploads table, a step that wasn't uploaded because
+# Canvas already had the same thing is unchanged
+NOT_UPLOADED = 0
+UPLOADED     = 1
+UNCHANGED    = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id          INTEGER PRIMARY KEY,
+    started_at  REAL NOT NULL,
+    finished_at REAL,
+    json_file   TEXT,
+    upload      INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS attempts (
+    id            INTEGER PRIMARY KEY,
+    run_id        INTEGER NOT NULL REFERENCES runs(id),
+    student_id    TEXT NOT NULL,
+    student_name  TEXT NOT NULL,
+    sub_file      TEXT NOT NULL,
+    score         REAL NOT NULL,
+    note          TEXT NOT NULL,
+    feedback_path TEXT NOT NULL,
+    feedback_hash TEXT,
+    cpu_seconds   REAL,
+    peak_rss_mb   REAL,
+    exit_reason   TEXT,
+    duration      REAL,
+    graded_at     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attempts_by_student ON attempts(student_id, id);
+CREATE INDEX IF NOT EXISTS attempts_by_run ON attempts(run_id);
+
+CREATE TABLE IF NOT EXISTS uploads (
+    attempt_id  INTEGER PRIMARY KEY REFERENCES attempts(id),
+    comment     INTEGER NOT NULL DEFAULT 0,
+    grade       INTEGER NOT NULL DEFAULT 0,
+    error       TEXT,
+    uploaded_at REAL,
+    canvas_attempt INTEGER
+);
+"""
+
+"""
+every grading attempt for an assignment, kept in a sqlite database in the dir to grade. each run adds a row
+to runs, each graded submission adds a row to attempts (nothing is ever overwritten, so the whole history
+is there to query) and uploads keeps track of which attempts have had their feedback and grade sent to
+Canvas. the database is in wal mode, every thread gets its own connection and every write is its own
+transaction, so a crash never leaves half of a result behind
+
+@params:
+    dir_to_grade - the directory to grade and download submissions to
+"""
+class Results_Store:
+    def __init__(self, dir_to_grade):
+        self.filename = os.path.join(dir_to_grade, RESULTS_DB_FILENAME)
+        self.local = threading.local()
+        self.run_id = None
+
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+            # results.db files made before uploads kept track of which Canvas attempt they were for
+            if ("canvas_attempt" not in [c["name"] for c in db.execute("PRAGMA table_info(uploads)")]):
+                db.execute("ALTER TABLE uploads ADD COLUMN canvas_attempt INTEGER")
+
+    # gets this thread's connection to the database, sqlite connections can't be shared between threads
+    def connect(self):
+        if (not hasattr(self.local, "db")):
+            self.local.db = sqlite3.connect(self.filename, timeout=BUSY_TIMEOUT_MS / 1000)
+            self.local.db.row_factory = sqlite3.Row
+            self.local.db.execute("PRAGMA journal_mode=WAL")
+            self.local.db.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return self.local.db
+
+    """
+    starts a new run, every attempt recorded after this belongs to it
+
+    @params:
+        json_filename - the json info file the run is grading with
+        upload        - whether the run's results are meant to be uploaded to Canvas
+    """
+    def start_run(self, json_filename, upload):
+        with self.connect() as db:
+            self.run_id = db.execute("INSERT INTO runs (started_at, json_file, upload) VALUES (?, ?, ?)",
+                                     (time.time(), json_filename, int(upload))).lastrowid
+        return self.run_id
+
+    def finish_run(self):
+        with self.connect() as db:
+            db.execute("UPDATE runs SET finished_at = ? WHERE id = ?", (time.time(), self.run_id))
+
+    """
+    records the result of grading one submission in the current run, returns the attempt's id
+
+    @params:
+        result        - the Grade_Result
+        feedback_path - where the feedback for the result was written
+        feedback_hash - the hash of the feedback file
+    """
+    def record_attempt(self, result, feedback_path, feedback_hash):
+        usage = result.usage
+
+        with self.connect() as db:
+            return db.execute("""INSERT INTO attempts (run_id, student_id, student_name, sub_file, score, note, feedback_path, feedback_hash,
+                                                       cpu_seconds, peak_rss_mb, exit_reason, duration, graded_at)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                              (self.run_id, str(result.student_id), result.student_name, result.sub_file, result.score, result.note,
+                               feedback_path, feedback_hash, usage["cpu_seconds"], usage["peak_rss_mb"], usage["exit_reason"],
+                               result.duration, time.time())).lastrowid
+
+    # gets the attempts from a run (the current run by default), in the order they would be graded in
+    def get_attempts(self, run_id=None):
+        run_id = self.run_id if run_id is None else run_id
+        return self.connect().execute("SELECT * FROM attempts WHERE run_id = ? ORDER BY sub_file", (run_id,)).fetchall()
+
+    def get_attempt(self, attempt_id):
+        return self.connect().execute("SELECT * FROM attempts WHERE id = ?", (attempt_id,)).fetchone()
+
+    """
+    gets the last attempt before this one that had a step uploaded (or found unchanged) for a student, along
+    with when that happened and which Canvas attempt it was for, or None if that step has never been done for them
+    """
+    def get_last_uploaded(self, student_id, step, before_attempt_id):
+        return self.connect().execute(f"""
+            SELECT a.*, u.uploaded_at, u.canvas_attempt FROM attempts a JOIN uploads u ON u.attempt_id = a.id
+            WHERE a.student_id = ? AND a.id < ? AND u.{step} != {NOT_UPLOADED}
+            ORDER BY a.id DESC LIMIT 1""", (str(student_id), before_attempt_id)).fetchone()
+
+    """
+    gets how long each student's latest attempt took to grade, by their Canvas id. this is what submissions
+    are ordered by, see shortest_first in gradingtools.py. results that came from the cache have no duration,
+    so they are skipped and the last real run is used
+    """
+    def get_durations(self):
+        rows = self.connect().execute("""
+            SELECT a.student_id, a.duration FROM attempts a
+            JOIN (SELECT student_id, MAX(id) AS id FROM attempts WHERE duration IS NOT NULL GROUP BY student_id) latest ON latest.id = a.id""").fetchall()
+        # local submissions have no assignment id in their name, so their student id still has the extension on it
+        return {r["student_id"].split(".")[0]: r["duration"] for r in rows}
+
+    # gets the id of the last run, or None if nothing has been graded yet
+    def get_last_run(self):
+        row = self.connect().execute("SELECT MAX(id) AS id FROM runs").fetchone()
+        return row["id"]
+
+    """
+    gets the attempts that still need to be uploaded: each student's latest attempt from a run that was meant
+    to be uploaded, if its comment or grade hasn't been uploaded yet. this picks up uploads from an earlier run
+    that failed or got interrupted, even when the submission isn't graded again
+    """
+    def get_pending_uploads(self):
+        return self.connect().execute(f"""
+            SELECT a.* FROM attempts a
+            JOIN (SELECT student_id, MAX(attempts.id) AS id FROM attempts JOIN runs ON runs.id = attempts.run_id
+                  WHERE runs.upload = 1 GROUP BY student_id) latest ON latest.id = a.id
+            LEFT JOIN uploads u ON u.attempt_id = a.id
+            WHERE u.attempt_id IS NULL OR u.comment = {NOT_UPLOADED} OR u.grade = {NOT_UPLOADED}
+            ORDER BY a.sub_file""").fetchall()
+
+    # checks if a step ("comment" or "grade") was already uploaded for an attempt
+    def is_uploaded(self, attempt_id, step):
+        row = self.connect().execute(f"SELECT {step} FROM uploads WHERE attempt_id = ?", (attempt_id,)).fetchone()
+        return bool(row and row[0])
+
+    # records that a step was uploaded (or didn't need to be) for an attempt, and the Canvas attempt it was for
+    def mark_uploaded(self, attempt_id, step, state=UPLOADED, canvas_attempt=None):
+        with self.connect() as db:
+            db.execute(f"""INSERT INTO uploads (attempt_id, {step}, uploaded_at, canvas_attempt) VALUES (?, ?, ?, ?)
+                           ON CONFLICT(attempt_id) DO UPDATE SET {step} = excluded.{step}, error = NULL, uploaded_at = excluded.uploaded_at,
+                                                                 canvas_attempt = excluded.canvas_attempt""",
+                       (attempt_id, state, time.time(), canvas_attempt))
+
+    # records why an upload failed for an attempt
+    def record_upload_error(self, attempt_id, error):
+        with self.connect() as db:
+            db.execute("""INSERT INTO uploads (attempt_id, error) VALUES (?, ?)
+                          ON CONFLICT(attempt_id) DO UPDATE SET error = excluded.error""", (attempt_id, error))
+
+    """
+    writes the attempts from a run to a csv file, in the same format results.csv has always had. it is written
+    to a temp file first so a crash never leaves half of a csv
+    """
+    def export_csv(self, csv_filename, run_id=None):
+        with open(f"{csv_filename}.tmp", "w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            for a in self.get_attempts(run_id):
+                writer.writerow([a["student_name"], a["student_id"], format_score(a["score"]), a["feedback_path"],
+                                 a["cpu_seconds"], a["peak_rss_mb"], a["exit_reason"]])
+        os.replace(f"{csv_filename}.tmp", csv_filename)
+
+    def close(self):
+        if (hasattr(self.local, "db")):
+            self.local.db.close()
+            del self.local.db
+
+# scores are stored as reals, whole scores are written without the .0 like they always have been
+def format_score(score):
+    return int(score) if float(score).is_integer() else score
+
+# prints every attempt for a student, newest first
+def print_history(store, student_id):
+    rows = store.connect().execute("SELECT * FROM attempts WHERE student_id = ? ORDER BY id DESC", (student_id,)).fetchall()
+
+    for a in rows:
+        graded_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(a["graded_at"]))
+        duration = "cached" if a["duration"] is None else f"{a['duration']:.2f}s"
+        print(f"run {a['run_id']:<5} {graded_at}  {format_score(a['score']):>6}  {a['exit_reason']:<12} {duration:>7}  {a['note']}")
+
+# gets the arguments for the program
+def get_args():
+    parser = argparse.ArgumentParser(description="Query the results store gradingtools.py keeps in a dir to grade")
+    parser.add_argument("directory", type=str, help="The dir that was graded")
+    parser.add_argument("--csv", type=str, help="Export a run to this csv file, in the results.csv format")
+    parser.add_argument("--run", type=int, help="The run to export, the last run by default")
+    parser.add_argument("--student", type=str, help="Show every attempt for the student with this Canvas id")
+    parser.add_argument("--pending", action="store_true", help="Show the attempts that still need to be uploaded")
+    return parser.parse_args()
+
+# main
+if (__name__ == "__main__"):
+    args = get_args()
+
+    if (not os.path.isfile(os.path.join(args.directory, RESULTS_DB_FILENAME))):
+        print(f"Error: {args.directory} has no {RESULTS_DB_FILENAME}, it hasn't been graded yet")
+        exit(1)
+
+    store = Results_Store(args.directory)
+
+    if (args.csv):
+        run_id = args.run if args.run is not None else store.get_last_run()
+        store.export_csv(args.csv, run_id)
+        print(f"Run {run_id} written to {args.csv}")
+    if (args.student):
+        print_history(store, args.student)
+    if (args.pending):
+        for a in store.get_pending_uploads():
+            print(json.dumps(dict(a)))
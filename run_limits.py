@@ -0,0 +1,106 @@
+import os
+import signal
+import resource
+
+# the limits that can be set in the "limits" object of the json file, and the rlimit and units for each
+LIMITS = {
+    "memory_mb":    (resource.RLIMIT_AS, 1024 * 1024),
+    "cpu_seconds":  (resource.RLIMIT_CPU, 1),
+    "processes":    (resource.RLIMIT_NPROC, 1),
+    "file_size_mb": (resource.RLIMIT_FSIZE, 1024 * 1024),
+}
+
+"""
+the limits put on every run of a student's program. the limits come from the "limits" object in the json
+file, any of them can be left out:
+        "limits": {
+            "memory_mb":    512,  - the most memory the program can map (RLIMIT_AS)
+            "cpu_seconds":  10,   - the most cpu time the program can use (RLIMIT_CPU)
+            "processes":    64,   - the most processes the user running the grader can have (RLIMIT_NPROC),
+                                    this counts every process the user has, not just the student's, and
+                                    does nothing when grading as root
+            "file_size_mb": 16    - the biggest file the program can write (RLIMIT_FSIZE)
+        }
+the program's stdout is capped separately by "max_output_bytes"
+"""
+class Run_Limits:
+    def __init__(self, limits, max_output_bytes):
+        self.limits = limits
+        self.max_output_bytes = max_output_bytes
+
+    # sets the limits in the child process right before the program starts
+    def apply(self):
+        for name, value in self.limits.items():
+            rlimit, units = LIMITS[name]
+            hard = value * units
+
+            # the kernel kills the program outright at the hard cpu limit, a second past the soft limit it
+            # gets SIGXCPU first so the exit reason shows it ran out of cpu time
+            if (rlimit == resource.RLIMIT_CPU):
+                hard += 1
+
+            resource.setrlimit(rlimit, (value * units, hard))
+
+"""
+the cpu time, peak memory and exit reason for all the runs of one submission. a run that ended badly sets
+the exit reason, only the first bad run is kept since anything after it usually just fails the same way.
+the peak memory is the kernel's max rss for the run, which starts out at the size of the grader process
+that started it, so small programs all show about the size of a grader worker
+"""
+class Run_Usage:
+    def __init__(self):
+        self.runs = 0
+        self.cpu_seconds = 0.0
+        self.peak_rss_kb = 0
+        self.exit_reason = "ok"
+
+    def add(self, rusage, exit_reason):
+        self.runs += 1
+        self.cpu_seconds += rusage.ru_utime + rusage.ru_stime
+        self.peak_rss_kb = max(self.peak_rss_kb, rusage.ru_maxrss)
+
+        if (self.exit_reason == "ok"):
+            self.exit_reason = exit_reason
+
+    # adds in the runs from another Run_Usage, like the one for each test case, in the order they were run
+    def merge(self, other):
+        self.runs += other.runs
+        self.cpu_seconds += other.cpu_seconds
+        self.peak_rss_kb = max(self.peak_rss_kb, other.peak_rss_kb)
+
+        if (self.exit_reason == "ok"):
+            self.exit_reason = other.exit_reason
+
+    # the usage as plain values, so it can be cached and written to the results csv
+    def summary(self):
+        return {
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "peak_rss_mb": round(self.peak_rss_kb / 1024, 1),
+            "exit_reason": self.exit_reason,
+        }
+
+"""
+works out why a program stopped from its wait status
+
+@params:
+    status          - the wait status from os.wait4
+    timed_out       - whether the program was killed for running past the timeout
+    too_much_output - whether the program was killed for printing more than max_output_bytes
+"""
+def get_exit_reason(status, timed_out, too_much_output):
+    if (timed_out):
+        return "timeout"
+    if (too_much_output):
+        return "output limit"
+
+    if (os.WIFSIGNALED(status)):
+        sig = os.WTERMSIG(status)
+
+        if (sig == signal.SIGXCPU):
+            return "cpu limit"
+        if (sig == signal.SIGXFSZ):
+            return "file size limit"
+        return signal.Signals(sig).name
+
+    code = os.waitstatus_to_exitcode(status)
+    return "ok" if code == 0 else f"exit {code}"
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# the trace file is passed to worker processes through their environment
+TRACE_ENV = "GRADING_TRACE"
+
+# args (like the submission) that every phase started inside of another phase gets too
+_phase_args = contextvars.ContextVar("phase_args", default={})
+
+# so events from different threads never end up on the same line
+_write_lock = threading.Lock()
+
+"""
+starts a new trace, every phase timed after this (in this process or any worker started after it) is written
+to the trace file as one line of json
+"""
+def start_trace(filename):
+    open(filename, "w").close()
+    os.environ[TRACE_ENV] = os.path.abspath(filename)
+
+# gets the trace file for this run, or None if nothing is being traced
+def get_trace_file():
+    return os.environ.get(TRACE_ENV)
+
+"""
+times a phase of the run and writes it to the trace. any args are saved with the phase, and are passed on to
+every phase inside of it, so the compile for a submission is tagged with that submission
+
+@params:
+    name - the name of the phase (compile, student run, upload, etc)
+    args - anything else to save with the phase, must be json serializable
+"""
+@contextmanager
+def phase(name, **args):
+    trace_file = get_trace_file()
+
+    if (trace_file is None):
+        yield
+        return
+
+    args  = {**_phase_args.get(), **args}
+    token = _phase_args.set(args)
+    start = time.time()
+
+    try:
+        yield
+    finally:
+        end = time.time()
+        _phase_args.reset(token)
+
+        event = {"name": name, "start": start, "duration": end - start, "pid": os.getpid(), "tid": threading.get_ident(), "args": args}
+
+        # appends of a single line are atomic, so every worker can write to the same file
+        with _write_lock, open(trace_file, "a") as f:
+            f.write(json.dumps(event, default=str) + "\n")
+
+# reads all the events from a trace file
+def read_trace(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+"""
+converts a trace to the chrome trace format, which can be opened in chrome://tracing or https://ui.perfetto.dev
+"""
+def export_chrome_trace(trace_filename, chrome_filename):
+    events = read_trace(trace_filename)
+    start  = min((e["start"] for e in events), default=0)
+
+    trace_events = [{
+        "name": e["name"],
+        "cat":  "grading",
+        "ph":   "X",
+        "ts":   (e["start"] - start) * 1e6,
+        "dur":  e["duration"] * 1e6,
+        "pid":  e["pid"],
+        "tid":  e["tid"],
+        "args": e["args"],
+    } for e in events]
+
+    with open(chrome_filename, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+# prints how long was spent in each phase, the phases that took the longest first. a phase inside of another
+# phase (like the compile inside of a grade) is counted in both
+def print_summary(trace_filename):
+    totals = {}
+
+    for e in read_trace(trace_filename):
+        count, total = totals.get(e["name"], (0, 0.0))
+        totals[e["name"]] = (count + 1, total + e["duration"])
+
+    print(f"{'Phase':<20} {'Count':>8} {'Total (s)':>12} {'Mean (ms)':>12}")
+    for name, (count, total) in sorted(totals.items(), key=lambda t: -t[1][1]):
+        print(f"{name:<20} {count:>8} {total:>12.3f} {total / count * 1000:>12.2f}")
+
+# gets the arguments for the program
+def get_args():
+    parser = argparse.ArgumentParser(description="Summarize or convert a trace written by gradingtools.py --trace")
+    parser.add_argument("trace", type=str, help="The trace file")
+    parser.add_argument("--chrome", type=str, help="Also write the trace in the chrome trace format to this file")
+    return parser.parse_args()
+
+# main
+if (__name__ == "__main__"):
+    args = get_args()
+
+    if (not os.path.isfile(args.trace)):
+        print(f"Error: {args.trace} was not found")
+        exit(1)
+
+    print_summary(args.trace)
+
+    if (args.chrome):
+        export_chrome_trace(args.trace, args.chrome)
+        print(f"\nChrome trace written to {args.chrome}")
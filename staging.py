@@ -0,0 +1,103 @@
+import os
+import stat
+import hashlib
+import tempfile
+import threading
+from shutil import copy, rmtree
+from contextlib import contextmanager
+
+# the staging root is passed to worker processes through their environment, it isn't set when staging on disk
+STAGING_ENV = "GRADING_STAGING"
+
+# where tmpfs staging puts its workspaces, this is RAM backed on every Linux distro
+TMPFS_DIR = "/dev/shm"
+
+# the files every workspace shares are staged once in here, and hardlinked into each workspace
+SHARED_DIR = ".shared"
+
+STAGING_BACKENDS = ["disk", "tmpfs"]
+
+"""
+where each submission is graded. with "disk" (the default) every submission is graded in its own directory
+in the dir to grade, and the files it needs are copied in, so everything is still there after grading.
+with "tmpfs" every workspace is made in a directory in /dev/shm instead: the files every workspace shares
+(the reference, required files, test inputs) are copied there once per run, made read only and hardlinked
+into each workspace, and only the feedback file is copied back to the dir to grade. each workspace is
+removed once it has been graded, and the whole staging directory is removed in one go when the run ends.
+
+a hardlinked file is the same file in every workspace, read only stops a student's program from changing
+it for everyone after it, unless the grader is being run as root
+"""
+@contextmanager
+def staging(backend):
+    if (backend == "disk"):
+        yield
+        return
+
+    if (not os.path.isdir(TMPFS_DIR)):
+        print(f"Error: {TMPFS_DIR} was not found, use '--staging disk' on this system")
+        exit(1)
+
+    root = tempfile.mkdtemp(prefix="gradingtools_", dir=TMPFS_DIR)
+    os.mkdir(os.path.join(root, SHARED_DIR))
+    os.environ[STAGING_ENV] = root
+
+    try:
+        yield
+    finally:
+        del os.environ[STAGING_ENV]
+        rmtree(root, ignore_errors=True)
+
+# gets the staging root for this run, or None when staging on disk
+def get_staging_root():
+    return os.environ.get(STAGING_ENV)
+
+# gets the directory a submission is graded in
+def get_workspace(dir_to_grade, sub_file):
+    return os.path.join(get_staging_root() or dir_to_grade, sub_file)
+
+"""
+puts a file every workspace needs into a workspace. on disk it is copied, on tmpfs it is copied into the
+staging root the first time any workspace needs it (by whichever worker gets there first) and hardlinked
+from there after that
+"""
+def stage_shared_file(filename, workspace):
+    root = get_staging_root()
+
+    if (root is None):
+        copy(filename, workspace)
+        return
+
+    # files with the same name from different places (like two test inputs) each get their own shared copy
+    key = hashlib.sha256(os.path.abspath(filename).encode()).hexdigest()[:16]
+    shared = os.path.join(root, SHARED_DIR, key, os.path.basename(filename))
+
+    if (not os.path.isfile(shared)):
+        os.makedirs(os.path.dirname(shared), exist_ok=True)
+
+        temp = f"{shared}.{os.getpid()}.{threading.get_ident()}.tmp"
+        copy(filename, temp)
+        os.chmod(temp, stat.S_IMODE(os.stat(temp).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        os.replace(temp, shared)
+
+    dest = os.path.join(workspace, os.path.basename(filename))
+    if (os.path.lexists(dest)):
+        os.remove(dest)
+    os.link(shared, dest)
+
+"""
+copies the files worth keeping (the feedback) from a staged workspace back to the submission's directory in
+the dir to grade and removes the workspace. does nothing on disk, the workspace is already there
+"""
+def finish_workspace(dir_to_grade, sub_file, keep):
+    if (get_staging_root() is None):
+        return
+
+    workspace = get_workspace(dir_to_grade, sub_file)
+    os.makedirs(os.path.join(dir_to_grade, sub_file), exist_ok=True)
+
+    for f in keep:
+        if (os.path.isfile(os.path.join(workspace, f))):
+            copy(os.path.join(workspace, f), os.path.join(dir_to_grade, sub_file, f))
+
+    rmtree(workspace, ignore_errors=True)
@@ -0,0 +1,69 @@
+import os
+
+from shutil import rmtree
+
+# the end of the name of the directory each submission's other files are kept in
+ATTACHMENTS_SUFFIX = ".attachments"
+
+"""
+gets the Canvas id of the student a file or directory in the dir to grade belongs to, or None if it
+doesn't belong to a student. submissions and their directories are named like:
+        <pid>_<canvas id>_<assignment id>_<submission name>.<file extension>
+        jamesw98_1234_4242_p2.hs
+        jamesw98_1234_4242_p2/
+"""
+def parse_student_id(entry):
+    sub_split = entry.split("_")
+
+    if (entry.startswith(".") or len(sub_split) < 2):
+        return None
+
+    student_id = sub_split[1].split(".")[0]
+    return student_id if student_id.isdigit() else None
+
+"""
+gets the directory a submission's other files (the rest of a multi-file submission, or everything else its
+archives had in them) are kept in, next to the submission in the dir to grade:
+        jamesw98_1234_4242_p2.hs
+        jamesw98_1234_4242.attachments/
+"""
+def get_attachments_dir(submission):
+    return "_".join(submission.split("_")[:3]) + ATTACHMENTS_SUFFIX
+
+"""
+an index of the dir to grade keyed on each student's Canvas id. it is built with one listdir when a run
+starts and is kept up to date as submissions are added and removed, so finding (and removing) a student's
+files never needs another scan of the directory
+"""
+class Submission_Index:
+    def __init__(self, dir_to_grade):
+        self.dir_to_grade = dir_to_grade
+        self.by_student = {}
+
+        for entry in os.listdir(dir_to_grade):
+            self.add(entry)
+
+    # adds a file or directory to the index, does nothing for anything that doesn't belong to a student
+    def add(self, entry):
+        student_id = parse_student_id(entry)
+        if (student_id is not None):
+            self.by_student.setdefault(student_id, set()).add(entry)
+
+    # gets the names of everything in the dir to grade that belongs to a student
+    def get(self, student_id):
+        return set(self.by_student.get(str(student_id), ()))
+
+    # removes all of a student's files and directories from the disk and the index
+    def remove_student(self, student_id):
+        for entry in self.by_student.pop(str(student_id), ()):
+            entry_path = os.path.join(self.dir_to_grade, entry)
+
+            if (os.path.isdir(entry_path)):
+                rmtree(entry_path)
+            elif (os.path.exists(entry_path)):
+                os.remove(entry_path)
+
+    # gets every student file (not directory) in the index
+    def files(self):
+        return [e for entries in self.by_student.values() for e in entries
+                if not os.path.isdir(os.path.join(self.dir_to_grade, e))]